@@ -0,0 +1,128 @@
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Union
+
+from atomic_file import write_atomic
+
+ARCHIVE_VIEW_DIR = "fa-extract/www.furaffinity.net/view/"
+
+
+class ArchiveIndex:
+    def __init__(self, view_dir=ARCHIVE_VIEW_DIR, index_prefix="archive_index"):
+        self.view_dir = view_dir
+        self.ids_file = f"{index_prefix}.ids"
+        self.offsets_file = f"{index_prefix}.offsets"
+        self.paths_file = f"{index_prefix}.paths"
+        self.meta_file = f"{index_prefix}.meta.json"
+        self.count = 0
+        self.ids = None
+        self.offsets = None
+        self.paths = None
+        self.maps = []
+
+    def view_mtime(self):
+        try:
+            return os.stat(self.view_dir).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def stored_mtime(self):
+        try:
+            with open(self.meta_file, "r") as f:
+                return json.load(f)["mtime"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return False
+
+    def load(self):
+        mtime = self.view_mtime()
+        if self.stored_mtime() != mtime:
+            self.build(mtime)
+        self.open()
+        return self
+
+    def open(self):
+        self.close()
+        self.count = os.path.getsize(self.ids_file) // 8
+        if self.count == 0:
+            return
+        ids_map = self.map_file(self.ids_file)
+        offsets_map = self.map_file(self.offsets_file)
+        self.paths = self.map_file(self.paths_file)
+        self.ids = memoryview(ids_map).cast("q")
+        self.offsets = memoryview(offsets_map).cast("q")
+
+    def map_file(self, filename):
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return mapped
+
+    def close(self):
+        if self.ids is not None:
+            self.ids.release()
+            self.offsets.release()
+        for mapped in self.maps:
+            mapped.close()
+        self.ids = None
+        self.offsets = None
+        self.paths = None
+        self.maps = []
+        self.count = 0
+
+    def existing_entries(self):
+        if not os.path.exists(self.ids_file):
+            return {}
+        self.open()
+        entries = {self.ids[i]: self.path_at(i) for i in range(self.count)}
+        self.close()
+        return entries
+
+    def build(self, mtime):
+        # Only list directories for submissions which are new since the last build
+        existing = self.existing_entries()
+        entries = {}
+        if os.path.exists(self.view_dir):
+            with os.scandir(self.view_dir) as view_entries:
+                for entry in view_entries:
+                    if not entry.is_dir() or not entry.name.isdigit():
+                        continue
+                    sub_id = int(entry.name)
+                    if sub_id in existing:
+                        entries[sub_id] = existing[sub_id]
+                        continue
+                    with os.scandir(entry.path) as sub_entries:
+                        files = sorted(x.name for x in sub_entries)
+                    if files:
+                        entries[sub_id] = f"{self.view_dir}{sub_id}/{files[0]}"
+        sub_ids = sorted(entries)
+        ids = array("q", sub_ids)
+        offsets = array("q", [0])
+        paths = bytearray()
+        for sub_id in sub_ids:
+            paths += entries[sub_id].encode("utf-8")
+            offsets.append(len(paths))
+        write_atomic(self.ids_file, ids.tobytes())
+        write_atomic(self.offsets_file, offsets.tobytes())
+        write_atomic(self.paths_file, bytes(paths))
+        write_atomic(self.meta_file, json.dumps({"mtime": mtime, "count": len(sub_ids)}).encode())
+        print(f"Indexed {len(sub_ids)} archive submissions, {len(sub_ids) - len(existing)} new")
+
+    def path_at(self, position):
+        return self.paths[self.offsets[position]:self.offsets[position + 1]].decode("utf-8")
+
+    def lookup(self, sub_id: int) -> Union[bool, str]:
+        if self.count == 0:
+            return False
+        position = bisect_left(self.ids, sub_id)
+        if position == self.count or self.ids[position] != sub_id:
+            return False
+        return self.path_at(position)
+
+
+if __name__ == "__main__":
+    view_dir = sys.argv[1] if len(sys.argv) > 1 else ARCHIVE_VIEW_DIR
+    ArchiveIndex(view_dir).load()
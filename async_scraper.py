@@ -0,0 +1,269 @@
+import asyncio
+import json
+import time
+from typing import Optional, Dict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from concurrency import ConcurrencyController, RateLimitedError, retry_delay
+from run import (
+    Scraper, APIDownloader, WebsiteDownloader, PageResult, StatusCache, USER_AGENT, response_validators,
+    run_getter_chunk
+)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    def __init__(self, rates: Dict[str, float], default_rate: float, burst: int):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.burst = burst
+        self.buckets = {}
+
+    def bucket_for(self, url: str) -> TokenBucket:
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            rate = self.rates.get(host, self.default_rate)
+            self.buckets[host] = TokenBucket(rate, self.burst)
+        return self.buckets[host]
+
+    async def acquire(self, url: str):
+        await self.bucket_for(url).acquire()
+
+
+class AsyncAPIDownloader(APIDownloader):
+    def __init__(
+            self,
+            sub_id: int,
+            api_url,
+            session: aiohttp.ClientSession,
+            limiter: HostRateLimiter,
+            status_cache: Optional[StatusCache] = None
+    ):
+        super().__init__(sub_id, api_url, status_cache=status_cache)
+        self.session = session
+        self.limiter = limiter
+
+    async def download_json(self, url, keep_validators: bool = False):
+        await self.limiter.acquire(url)
+        async with self.session.get(url, headers={"User-Agent": USER_AGENT}) as resp:
+            if resp.status in [429, 503]:
+                raise RateLimitedError(resp.status, f"API is rate limiting us. ({resp.status})")
+            if resp.status >= 500:
+                raise Exception(f"API server error. ({resp.status})")
+            if resp.status != 200:
+                return None
+            body = await resp.read()
+            self.bytes_received += len(body)
+            if keep_validators:
+                self.validators = response_validators(resp)
+            return json.loads(body)
+
+    async def download_status(self):
+        if self.status_cache is not None:
+            status = self.status_cache.cached(self.base_url())
+            if status is not None:
+                return status
+        status = await self.download_json(self.make_url("/status.json"))
+        if self.status_cache is not None and status is not None:
+            self.status_cache.store(self.base_url(), status)
+        return status
+
+    async def result(self) -> Optional[PageResult]:
+        data = await self.download_json(self.make_url(f"/submission/{self.sub_id}.json"), keep_validators=True)
+        status = await self.download_status()
+        self.read_status(status)
+        return self.parse_sub_data(data)
+
+
+class AsyncWebsiteDownloader(WebsiteDownloader):
+    def __init__(
+            self,
+            sub_id: int,
+            login_cookie: dict,
+            session: aiohttp.ClientSession,
+            limiter: HostRateLimiter,
+            parser_backend: str = "html.parser",
+            site_url: str = "http://furaffinity.net"
+    ):
+        super().__init__(sub_id, login_cookie, parser_backend=parser_backend, site_url=site_url)
+        self.session = session
+        self.limiter = limiter
+
+    async def download_page(self):
+        url = f"{self.site_url}/view/{self.sub_id}"
+        await self.limiter.acquire(url)
+        async with self.session.get(url, cookies=self.login_cookie, headers={"User-Agent": USER_AGENT}) as resp:
+            if resp.status == 200:
+                body = await resp.read()
+                self.bytes_received += len(body)
+                self.validators = response_validators(resp)
+                return body
+            if resp.status in [429, 503]:
+                raise RateLimitedError(resp.status, f"FA is rate limiting us. ({resp.status})")
+            raise Exception(f"Did not receive 200 response from FA. ({resp.status})")
+
+    async def result(self) -> Optional[PageResult]:
+        html = await self.download_page()
+        return self.parse_page(html)
+
+
+class AsyncScraper(Scraper):
+    def __init__(self, config):
+        super().__init__(config)
+        async_config = config.get("ASYNC", {})
+        self.in_flight = async_config.get("IN_FLIGHT", 32)
+        self.host_rates = async_config.get("HOST_RATES", {})
+        self.default_host_rate = async_config.get("DEFAULT_HOST_RATE", 5)
+        self.host_burst = async_config.get("HOST_BURST", 5)
+        self.controller = ConcurrencyController(
+            config.get("MAX_IN_FLIGHT", self.in_flight),
+            peak_limit=config.get("PEAK_IN_FLIGHT", 2),
+            target_latency=config.get("TARGET_LATENCY", 3.0)
+        )
+        self.session = None
+        self.limiter = None
+        self.batches = {}
+
+    def make_async(self, downloader):
+        if isinstance(downloader, APIDownloader):
+            return AsyncAPIDownloader(
+                downloader.sub_id, downloader.api_url, self.session, self.limiter, self.status_cache
+            )
+        if isinstance(downloader, WebsiteDownloader):
+            return AsyncWebsiteDownloader(
+                downloader.sub_id,
+                downloader.login_cookie,
+                self.session,
+                self.limiter,
+                downloader.parser_backend,
+                downloader.site_url
+            )
+        return None
+
+    async def attempt_download(self, downloader, async_downloader):
+        loop = asyncio.get_running_loop()
+        getter = downloader.__class__.__name__
+        args = {"id": downloader.sub_id}
+        if async_downloader is None:
+            start_time = time.monotonic()
+            start_ns = time.perf_counter_ns()
+            result = await loop.run_in_executor(None, downloader.result)
+            self.tracer.add(getter, start_ns, time.perf_counter_ns() - start_ns, args=args)
+            self.metrics.observe("fa_indexer_request_seconds", time.monotonic() - start_time, getter=getter)
+            return result
+        # Coroutines share the loop's thread, so spans are timed here and added whole rather than nested
+        wait_start = time.monotonic()
+        wait_ns = time.perf_counter_ns()
+        await self.controller.acquire_async()
+        start_time = time.monotonic()
+        start_ns = time.perf_counter_ns()
+        self.tracer.add("throttle_wait", wait_ns, start_ns - wait_ns, args=args)
+        self.metrics.inc("fa_indexer_throttle_wait_seconds_total", start_time - wait_start, getter=getter)
+        status = None
+        try:
+            return await async_downloader.result()
+        except RateLimitedError as e:
+            status = e.status_code
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            latency = time.monotonic() - start_time
+            self.tracer.add(getter, start_ns, time.perf_counter_ns() - start_ns, args=args)
+            self.metrics.observe("fa_indexer_request_seconds", latency, getter=getter)
+            self.controller.release(latency, status, async_downloader.should_slow_down())
+
+    async def async_download_entry(self, sub_id):
+        loop = asyncio.get_running_loop()
+        downloader = await loop.run_in_executor(None, self.pick_downloader, sub_id)
+        async_downloader = self.make_async(downloader)
+        if async_downloader is None and downloader.cpu_bound and self.process_pool is not None:
+            # The worker measures its own copy of the getter, so its timings come back with the result
+            [(result, timings)] = await loop.run_in_executor(self.process_pool, run_getter_chunk, [downloader])
+            if not isinstance(result, Exception):
+                self.record_worker_result(downloader, result, timings)
+                return result
+            # Fall back to the usual retry loop in this process
+        for attempt in range(self.retries + 1):
+            try:
+                result = await self.attempt_download(downloader, async_downloader)
+                break
+            except Exception as e:
+                self.record_retry(downloader, e)
+                if attempt == self.retries:
+                    self.dead_letter(sub_id, e)
+                    return None
+                await asyncio.sleep(retry_delay(attempt))
+        if async_downloader is not None:
+            downloader = async_downloader
+        self.record_result(downloader, result)
+        return None if result is None else result.to_dict()
+
+    async def complete_entry(self, sub_id, result):
+        batch_start = (sub_id // self.batch_size) * self.batch_size
+        batch = self.batches[batch_start]
+        batch["data"][str(sub_id)] = result
+        batch["remaining"] -= 1
+        if batch["remaining"] == 0:
+            del self.batches[batch_start]
+            full_data = {key: batch["data"][key] for key in sorted(batch["data"], key=int)}
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.save_batch, batch_start, full_data)
+            self.tracer.flush()
+            print(f"END BATCH: {batch_start} - {batch_start + self.batch_size - 1}")
+            self.metrics.batch_done(self.batch_size)
+
+    async def worker(self, id_iter):
+        for sub_id in id_iter:
+            result = await self.async_download_entry(sub_id)
+            await self.complete_entry(sub_id, result)
+
+    def id_range(self, start, end):
+        batch_start = (start // self.batch_size) * self.batch_size
+        while (end is None) or (batch_start < end):
+            if not self.should_scrape_batch(batch_start):
+                self.metrics.batch_done(self.batch_size, skipped=True)
+                batch_start += self.batch_size
+                continue
+            print(f"START BATCH: {batch_start} - {batch_start + self.batch_size - 1}")
+            self.batches[batch_start] = {"data": {}, "remaining": self.batch_size}
+            for sub_id in range(batch_start, batch_start + self.batch_size):
+                yield sub_id
+            batch_start += self.batch_size
+
+    async def async_scrape(self, start=1, end=None):
+        self.limiter = HostRateLimiter(self.host_rates, self.default_host_rate, self.host_burst)
+        connector = aiohttp.TCPConnector(limit=self.in_flight)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.session = session
+            id_iter = self.id_range(start, end)
+            await asyncio.gather(*[self.worker(id_iter) for _ in range(self.in_flight)])
+        self.session = None
+
+    def scrape(self, start=1, end=None):
+        stop_summary = self.start_summary((start // self.batch_size) * self.batch_size, end)
+        asyncio.run(self.async_scrape(start, end))
+        stop_summary.set()
+        self.tracer.flush()
@@ -0,0 +1,16 @@
+import os
+import uuid
+
+
+def write_atomic(filename, data: bytes):
+    # Readers only ever see the old or the new file. Each writer has its own temporary file, so two writers of the same
+    # file, such as a read compressing a batch while an upload replaces it, never collide
+    tmp_filename = f"{filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
@@ -0,0 +1,481 @@
+import datetime
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+# Usage: python bench.py run [bench config json] [report file]
+# or: python bench.py compare <baseline report> <new report>
+# or: python bench.py record <fixtures dir> <start id> <end id>
+
+DEFAULT_SETTINGS = {
+    "FIXTURES_DIR": "bench_fixtures/",
+    "SEED": 1,
+    "LATENCY": 0.05,
+    "LATENCY_JITTER": 0.02,
+    "ERROR_RATE": 0.01,
+    "MISSING_RATE": 0.05,
+    "REGISTERED": 500,
+    "SCRAPE_START": 1000000,
+    "SCRAPE_IDS": 1000,
+    "SCRAPER_CONFIG": {"WORKERS": 8, "RETRIES": 2, "SUMMARY_SECONDS": 3600},
+    "PARSE_REPEAT": 3,
+    "FILE_BATCHES": 200,
+    "TRACE_SPANS": 200000,
+    "SYNTHETIC_PAGES": 200,
+    "REGRESSION_THRESHOLD": 0.1
+}
+
+
+def synthetic_submission(sub_id: int) -> dict:
+    rng = random.Random(sub_id)
+    user = f"user{rng.randrange(5000)}"
+    return {
+        "profile_name": user,
+        "title": f"Submission {sub_id}",
+        "description": " ".join(rng.choice(["fox", "deer", "wolf", "sketch", "commission"]) for _ in range(40)),
+        "keywords": rng.sample(["fox", "deer", "wolf", "sketch", "commission", "digital", "traditional"], 3),
+        "posted_at": (datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=sub_id)).isoformat() + "Z",
+        "rating": rng.choice(["general", "mature", "adult"]),
+        "download": f"https://d.facdn.net/art/{user}/{sub_id}/{sub_id}.file.png"
+    }
+
+
+def synthetic_fields(sub_id: int) -> dict:
+    data = synthetic_submission(sub_id)
+    posted = datetime.datetime.fromisoformat(data["posted_at"].rstrip("Z"))
+    return {
+        "user": data["profile_name"],
+        "title": data["title"],
+        "description": data["description"],
+        "keywords": "".join(f'<a href="/search/@keywords {x}">{x}</a> ' for x in data["keywords"]),
+        "date": posted.strftime("%b %d, %Y %I:%M %p"),
+        "rating": data["rating"].capitalize(),
+        "download": data["download"].replace("https:", "")
+    }
+
+
+def synthetic_view_page(sub_id: int, registered: int) -> bytes:
+    # Laid out like a classic theme /view/ page, with just the parts the parsers read
+    fields = synthetic_fields(sub_id)
+    return f"""<html><body>
+<div id="page-submission">
+<table class="maintable"><tr><td>
+<table class="maintable">
+<tr><td class="classic-submission-title container">
+<div class="information"><h2>{fields["title"]}</h2>by <a href="/user/{fields["user"]}/">{fields["user"]}</a></div>
+</td></tr>
+<tr><td class="alt1 stats-container">
+<b>Posted:</b> <span class="popup_date" title="{fields["date"]}">a while ago</span><br/>
+<img alt="{fields["rating"]} rating" src="/themes/classic/img/labels/{fields["rating"].lower()}.gif"/>
+<div id="keywords">{fields["keywords"]}</div>
+</td></tr>
+<tr><td class="alt1">{fields["description"]}<br/>Thanks for looking!</td></tr>
+</table>
+</td></tr></table>
+<div class="actions"><b><a href="/fav/{sub_id}/">+Add to Favorites</a></b> <b><a href="{fields["download"]}">Download</a></b></div>
+</div>
+<div class="footer"><center>{registered} <b>registered</b>, 0 guests</center></div>
+</body></html>""".encode()
+
+
+def synthetic_missing_page() -> bytes:
+    return b"""<html><body><table class="maintable"><tr><td class="cat"><b>System Message</b></td></tr>
+<tr><td class="alt1">The submission you are trying to find is not in our database.</td></tr></table></body></html>"""
+
+
+def synthetic_archive_page(sub_id: int) -> bytes:
+    # Laid out like the old theme pages Archive Team saved
+    fields = synthetic_fields(sub_id)
+    return f"""<html><body>
+<table class="maintable"><tr><td>
+<table class="maintable"><tr><td>
+<table class="maintable">
+<tr><td class="cat"><b>{fields["title"]}</b> - by <a href="/user/{fields["user"]}/">{fields["user"]}</a></td></tr>
+<tr><td class="alt1"><table><tr><td class="alt1">
+<b>Posted:</b> <span class="popup_date">{fields["date"]}</span><br/>
+<img alt="{fields["rating"]} rating" src="/img/labels/{fields["rating"].lower()}.gif"/>
+<div id="keywords">{fields["keywords"]}</div>
+</td></tr></table></td></tr>
+<tr><td class="alt1"><b>{fields["title"]}</b><br/><br/>{fields["description"]}</td></tr>
+</table>
+</td></tr></table>
+</td></tr></table>
+<div class="actions"><a href="{fields["download"]}"> Download </a></div>
+</body></html>""".encode()
+
+
+def load_fixtures(fixtures_dir: str, kind: str, extension: str) -> list:
+    fixtures = []
+    for filename in sorted(glob.glob(os.path.join(fixtures_dir, kind, f"*.{extension}"))):
+        with open(filename, "rb") as f:
+            fixtures.append(f.read())
+    return fixtures
+
+
+class StandInServer:
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.view_pages = load_fixtures(settings["FIXTURES_DIR"], "view", "html")
+        self.submissions = load_fixtures(settings["FIXTURES_DIR"], "submission", "json")
+        self.random = random.Random(settings["SEED"])
+        self.requests = 0
+        self.server = None
+
+    def registered_page(self, html: bytes) -> bytes:
+        registered = str(self.settings["REGISTERED"]).encode()
+        return re.sub(rb"[0-9]+(\s*<b>registered)", registered + rb"\1", html, count=1, flags=re.I)
+
+    def status(self) -> bytes:
+        return json.dumps({"online": {"registered": self.settings["REGISTERED"], "guests": 0, "other": 0}}).encode()
+
+    def submission(self, sub_id: int) -> bytes:
+        if self.submissions:
+            return self.submissions[sub_id % len(self.submissions)]
+        return json.dumps(synthetic_submission(sub_id)).encode()
+
+    def view_page(self, sub_id: int) -> bytes:
+        if self.view_pages:
+            return self.registered_page(self.view_pages[sub_id % len(self.view_pages)])
+        return synthetic_view_page(sub_id, self.settings["REGISTERED"])
+
+    def respond(self, path: str):
+        self.requests += 1
+        delay = self.settings["LATENCY"] + self.random.uniform(0, self.settings["LATENCY_JITTER"])
+        fails = self.random.random() < self.settings["ERROR_RATE"]
+        missing = self.random.random() < self.settings["MISSING_RATE"]
+        time.sleep(delay)
+        if fails:
+            return 503, "text/plain", b"Service unavailable"
+        if path == "/status.json":
+            return 200, "application/json", self.status()
+        match = re.fullmatch(r"/submission/([0-9]+)\.json", path)
+        if match:
+            if missing:
+                return 404, "application/json", b"{}"
+            return 200, "application/json", self.submission(int(match.group(1)))
+        match = re.fullmatch(r"/view/([0-9]+)/?", path)
+        if match:
+            if missing:
+                return 200, "text/html", synthetic_missing_page()
+            return 200, "text/html", self.view_page(int(match.group(1)))
+        return 404, "text/plain", b"Not found"
+
+    def start(self) -> str:
+        stand_in = self
+
+        class StandInHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, content_type, body = stand_in.respond(self.path.split("?")[0])
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WorkDir:
+    def __init__(self):
+        self.previous = None
+        self.path = None
+
+    def __enter__(self):
+        self.previous = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix="fa_indexer_bench_")
+        os.chdir(self.path)
+        return self.path
+
+    def __exit__(self, *args):
+        os.chdir(self.previous)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def page_source(recorded: list) -> str:
+    # Rates from synthetic pages aren't comparable with rates from recorded ones
+    return "recorded" if recorded else "synthetic"
+
+
+def rate_result(count: int, duration: float, unit: str, **extra) -> dict:
+    result = {"count": count, "seconds": round(duration, 4), f"{unit}_per_second": count / duration if duration else 0}
+    result.update(extra)
+    return result
+
+
+def bench_scrape(settings: dict, source: str) -> dict:
+    from run import Scraper
+    stand_in = StandInServer(settings)
+    url = stand_in.start()
+    config = dict(settings["SCRAPER_CONFIG"])
+    if source == "api":
+        config["API_URL"] = url
+    else:
+        config["LOGIN_COOKIE"] = {}
+        config["FA_URL"] = url
+    start = settings["SCRAPE_START"]
+    end = start + settings["SCRAPE_IDS"] - 1
+    try:
+        with WorkDir():
+            scraper = Scraper(config)
+            start_time = time.perf_counter()
+            scraper.scrape(start, end)
+            duration = time.perf_counter() - start_time
+            scraper.pool.close()
+    finally:
+        stand_in.stop()
+    return rate_result(
+        settings["SCRAPE_IDS"], duration, "ids",
+        pages=page_source(stand_in.view_pages if source == "website" else stand_in.submissions),
+        requests=stand_in.requests,
+        dead_letters=len(scraper.dead_letters),
+        http=scraper.http.stats()
+    )
+
+
+def bench_parse_website(settings: dict) -> dict:
+    from run import WebsiteDownloader
+    from parsers import resolve_backend
+    recorded = load_fixtures(settings["FIXTURES_DIR"], "view", "html")
+    pages = recorded or [
+        synthetic_view_page(settings["SCRAPE_START"] + x, settings["REGISTERED"])
+        for x in range(settings["SYNTHETIC_PAGES"])
+    ]
+    backend = resolve_backend(settings["SCRAPER_CONFIG"].get("PARSER", "auto"))
+    start_time = time.perf_counter()
+    for _ in range(settings["PARSE_REPEAT"]):
+        for sub_id, html in enumerate(pages):
+            WebsiteDownloader(sub_id, {}, parser_backend=backend).parse_page(html)
+    duration = time.perf_counter() - start_time
+    return rate_result(
+        len(pages) * settings["PARSE_REPEAT"], duration, "pages", backend=backend, pages=page_source(recorded)
+    )
+
+
+def bench_parse_archive(settings: dict) -> dict:
+    from run import ArchiveTeamReader
+    from parsers import resolve_backend
+    recorded = sorted(glob.glob(os.path.join(settings["FIXTURES_DIR"], "archive", "*.html")))
+    backend = resolve_backend(settings["SCRAPER_CONFIG"].get("PARSER", "auto"))
+    with WorkDir() as work_dir:
+        files = list(recorded)
+        if not files:
+            for x in range(settings["SYNTHETIC_PAGES"]):
+                files.append(os.path.join(work_dir, f"{x}.html"))
+                with open(files[-1], "wb") as f:
+                    f.write(synthetic_archive_page(settings["SCRAPE_START"] + x))
+        start_time = time.perf_counter()
+        for _ in range(settings["PARSE_REPEAT"]):
+            for sub_id, file_name in enumerate(files):
+                ArchiveTeamReader(sub_id, file_name, backend).result()
+        duration = time.perf_counter() - start_time
+    return rate_result(
+        len(files) * settings["PARSE_REPEAT"], duration, "pages", backend=backend, pages=page_source(recorded)
+    )
+
+
+def synthetic_batch(batch_start: int, batch_size: int) -> dict:
+    full_data = {}
+    for sub_id in range(batch_start, batch_start + batch_size):
+        data = synthetic_submission(sub_id)
+        full_data[str(sub_id)] = {
+            "id": sub_id,
+            "username": data["profile_name"],
+            "title": data["title"],
+            "description": data["description"],
+            "keywords": data["keywords"],
+            "date": data["posted_at"],
+            "rating": data["rating"],
+            "filename": data["download"]
+        }
+    return full_data
+
+
+def bench_save_batch(settings: dict, storage: str) -> dict:
+    from run import Scraper
+    config = dict(settings["SCRAPER_CONFIG"])
+    config["STORAGE"] = storage
+    with WorkDir():
+        scraper = Scraper(config)
+        batches = [
+            (batch_start, synthetic_batch(batch_start, scraper.batch_size))
+            for batch_start in range(0, settings["FILE_BATCHES"] * scraper.batch_size, scraper.batch_size)
+        ]
+        start_time = time.perf_counter()
+        for batch_start, full_data in batches:
+            scraper.save_batch(batch_start, full_data)
+        duration = time.perf_counter() - start_time
+        scraper.pool.close()
+    return rate_result(len(batches), duration, "batches", storage=storage)
+
+
+def bench_get_file_data(settings: dict) -> dict:
+    from run import Scraper
+    with WorkDir():
+        scraper = Scraper(dict(settings["SCRAPER_CONFIG"]))
+        filenames = []
+        for batch_start in range(0, settings["FILE_BATCHES"] * scraper.batch_size, scraper.batch_size):
+            scraper.write_batch(batch_start, synthetic_batch(batch_start, scraper.batch_size))
+            directory, filename = scraper.filename_for_id(batch_start)
+            filenames.append(directory + filename)
+        results = {}
+        for phase in ["cold", "warm"]:
+            start_time = time.perf_counter()
+            for filename in filenames:
+                scraper.get_file_data(filename)
+            results[phase] = rate_result(len(filenames), time.perf_counter() - start_time, "files")
+        results["cache"] = scraper.file_cache.stats()
+        scraper.pool.close()
+    return results
+
+
+def bench_trace_overhead(settings: dict) -> dict:
+    from tracing import Tracer
+    count = settings["TRACE_SPANS"]
+    results = {}
+    start_time = time.perf_counter()
+    for _ in range(count):
+        pass
+    results["baseline"] = rate_result(count, time.perf_counter() - start_time, "loops")
+    with WorkDir() as work_dir:
+        for phase, tracer in [("disabled", Tracer()), ("enabled", Tracer(os.path.join(work_dir, "trace")))]:
+            start_time = time.perf_counter()
+            for _ in range(count):
+                with tracer.span("bench"):
+                    pass
+            duration = time.perf_counter() - start_time
+            tracer.close()
+            results[phase] = rate_result(count, duration, "spans", ns_per_span=round(duration * 1e9 / count, 1))
+    return results
+
+
+def git_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True)
+        return output.stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(settings: dict) -> dict:
+    from run import VERSION
+    benchmarks = {
+        "scrape_api": lambda: bench_scrape(settings, "api"),
+        "scrape_website": lambda: bench_scrape(settings, "website"),
+        "parse_website": lambda: bench_parse_website(settings),
+        "parse_archive": lambda: bench_parse_archive(settings),
+        "get_file_data": lambda: bench_get_file_data(settings),
+        "save_batch_json": lambda: bench_save_batch(settings, "json"),
+        "save_batch_segments": lambda: bench_save_batch(settings, "segments"),
+        "trace_overhead": lambda: bench_trace_overhead(settings)
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        print(f"Running benchmark: {name}")
+        results[name] = benchmark()
+        print(f"{name}: {json.dumps(results[name])}")
+    return {
+        "time": datetime.datetime.now().isoformat(),
+        "version": VERSION,
+        "commit": git_commit(),
+        "settings": settings,
+        "results": results
+    }
+
+
+def rates(results: dict, prefix: str = "") -> dict:
+    found = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            found.update(rates(value, f"{prefix}{key}."))
+        elif key.endswith("_per_second"):
+            found[f"{prefix}{key}"] = value
+    return found
+
+
+def compare_reports(baseline: dict, report: dict, threshold: float) -> list:
+    regressions = []
+    new_rates = rates(report["results"])
+    for key, old_rate in rates(baseline["results"]).items():
+        new_rate = new_rates.get(key)
+        if new_rate is None or not old_rate:
+            continue
+        change = (new_rate - old_rate) / old_rate
+        print(f"{key}: {old_rate:.1f} -> {new_rate:.1f} ({change:+.1%})")
+        if change < -threshold:
+            regressions.append(key)
+    return regressions
+
+
+def record_fixtures(fixtures_dir: str, start: int, end: int):
+    import requests
+    from run import APIDownloader, USER_AGENT
+    with open("config.json", "r") as f:
+        conf = json.load(f)
+    session = requests.Session()
+    for sub_id in range(start, end + 1):
+        if "API_URL" in conf:
+            path = os.path.join(fixtures_dir, "submission", f"{sub_id}.json")
+            url = APIDownloader(sub_id, conf["API_URL"]).make_url(f"/submission/{sub_id}.json")
+            resp = session.get(url, headers={"User-Agent": USER_AGENT})
+        else:
+            path = os.path.join(fixtures_dir, "view", f"{sub_id}.html")
+            resp = session.get(
+                f"{conf.get('FA_URL', 'http://furaffinity.net')}/view/{sub_id}",
+                cookies=conf["LOGIN_COOKIE"],
+                headers={"User-Agent": USER_AGENT}
+            )
+        if resp.status_code != 200:
+            print(f"Skipping {sub_id}: {resp.status_code}")
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(resp.content)
+        time.sleep(1)
+    print(f"Recorded fixtures to {fixtures_dir}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "run":
+        bench_settings = dict(DEFAULT_SETTINGS)
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], "r") as f:
+                bench_settings.update(json.load(f))
+        bench_settings["FIXTURES_DIR"] = os.path.abspath(bench_settings["FIXTURES_DIR"])
+        report_file = sys.argv[3] if len(sys.argv) > 3 else "bench_report.json"
+        bench_report = run_benchmarks(bench_settings)
+        with open(report_file, "w") as f:
+            json.dump(bench_report, f, indent=2)
+        print(f"Wrote report to {report_file}")
+    elif sys.argv[1] == "compare":
+        with open(sys.argv[2], "r") as f:
+            baseline_report = json.load(f)
+        with open(sys.argv[3], "r") as f:
+            new_report = json.load(f)
+        threshold = new_report["settings"].get("REGRESSION_THRESHOLD", 0.1)
+        regressed = compare_reports(baseline_report, new_report, threshold)
+        if regressed:
+            print(f"Regressions over {threshold:.0%}: {', '.join(regressed)}")
+            sys.exit(1)
+    elif sys.argv[1] == "record":
+        record_fixtures(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
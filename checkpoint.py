@@ -0,0 +1,106 @@
+import json
+import os
+import struct
+import sys
+from threading import Lock
+from typing import List, Tuple
+
+from atomic_file import write_atomic
+
+HEADER = struct.Struct("<qq")
+
+
+class BatchManifest:
+    def __init__(self, filename="batch_manifest.bin", batch_size=100):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.complete = bytearray()
+        self.partial = bytearray()
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        batch_size, length = HEADER.unpack_from(data)
+        if batch_size != self.batch_size:
+            raise Exception(f"Batch manifest was written with batch size {batch_size}, not {self.batch_size}")
+        self.complete = bytearray(data[HEADER.size:HEADER.size + length])
+        self.partial = bytearray(data[HEADER.size + length:HEADER.size + 2 * length])
+
+    def save(self):
+        data = HEADER.pack(self.batch_size, len(self.complete)) + bytes(self.complete) + bytes(self.partial)
+        write_atomic(self.filename, data)
+
+    def position(self, batch_start: int) -> Tuple[int, int]:
+        batch_num = batch_start // self.batch_size
+        return batch_num // 8, 1 << (batch_num % 8)
+
+    def get_bit(self, bitmap: bytearray, batch_start: int) -> bool:
+        byte, mask = self.position(batch_start)
+        return byte < len(bitmap) and bool(bitmap[byte] & mask)
+
+    def set_bits(self, batch_start: int, complete: bool, partial: bool):
+        byte, mask = self.position(batch_start)
+        if byte >= len(self.complete):
+            extra = byte + 1 - len(self.complete)
+            self.complete.extend(bytes(extra))
+            self.partial.extend(bytes(extra))
+        self.complete[byte] = self.complete[byte] | mask if complete else self.complete[byte] & ~mask
+        self.partial[byte] = self.partial[byte] | mask if partial else self.partial[byte] & ~mask
+
+    def is_complete(self, batch_start: int) -> bool:
+        return self.get_bit(self.complete, batch_start)
+
+    def is_partial(self, batch_start: int) -> bool:
+        return self.get_bit(self.partial, batch_start)
+
+    def mark(self, batch_start: int, full_data: dict, save: bool = True):
+        # A batch is partial if any of its entries are null, so gap filling can retry them
+        partial = any(x is None for x in full_data.values())
+        with self.lock:
+            self.set_bits(batch_start, True, partial)
+            if save:
+                self.save()
+
+    def gaps(self, start: int, end: int, include_partial: bool = False) -> List[List[int]]:
+        ranges = []
+        batch_start = (start // self.batch_size) * self.batch_size
+        while batch_start < end:
+            missing = not self.is_complete(batch_start) or (include_partial and self.is_partial(batch_start))
+            if missing:
+                if ranges and ranges[-1][1] == batch_start - 1:
+                    ranges[-1][1] = batch_start + self.batch_size - 1
+                else:
+                    ranges.append([batch_start, batch_start + self.batch_size - 1])
+            batch_start += self.batch_size
+        return ranges
+
+
+def rebuild_manifest(data_dir="data/", filename="batch_manifest.bin", batch_size=100):
+    from scan import batch_files
+    manifest = BatchManifest(filename, batch_size)
+    count = 0
+    for batch_file in batch_files(data_dir):
+        batch_start = int(os.path.basename(batch_file).split("-")[1])
+        with open(batch_file, "r") as f:
+            full_data = json.load(f)
+        # Batches cut short by a crash are left unmarked, so they are scraped again
+        if len(full_data) == batch_size:
+            manifest.mark(batch_start, full_data, save=False)
+        count += 1
+    manifest.save()
+    print(f"Marked {count} batch files in {filename}")
+
+
+if __name__ == "__main__":
+    # Usage: python checkpoint.py rebuild [data dir]
+    # or: python checkpoint.py gaps <start> <end>
+    if sys.argv[1] == "rebuild":
+        rebuild_manifest(*sys.argv[2:3])
+    elif sys.argv[1] == "gaps":
+        for gap_start, gap_end in BatchManifest().gaps(int(sys.argv[2]), int(sys.argv[3]), include_partial=True):
+            print(f"{gap_start} - {gap_end}")
@@ -0,0 +1,73 @@
+import asyncio
+import random
+from threading import Condition
+from typing import Optional, Union
+
+
+class RateLimitedError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ConcurrencyController:
+    def __init__(
+            self,
+            max_limit: int,
+            min_limit: int = 1,
+            peak_limit: int = 2,
+            target_latency: float = 3.0,
+            decrease_factor: float = 0.5
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.peak_limit = max(min_limit, min(peak_limit, max_limit))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.limit = float(max_limit)
+        self.peak = False
+        self.in_flight = 0
+        self.condition = Condition()
+
+    def ceiling(self) -> int:
+        return self.peak_limit if self.peak else self.max_limit
+
+    def try_acquire(self) -> bool:
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self, latency: float, status: Union[None, int, str] = None, slow_down: Optional[bool] = None):
+        with self.condition:
+            self.in_flight -= 1
+            if slow_down is not None:
+                self.peak = slow_down
+            if status in [429, 503]:
+                # Explicit back pressure from the server
+                self.limit = self.limit * self.decrease_factor
+            elif status is not None or latency > self.target_latency:
+                self.limit = self.limit * (1 - (1 - self.decrease_factor) / 4)
+            else:
+                # Additive increase, by roughly one request per full window of successes
+                self.limit += 1 / max(1.0, self.limit)
+            if self.limit > self.ceiling():
+                # Ease down towards the peak time ceiling, rather than dropping straight to it
+                self.limit = max(self.ceiling(), self.limit * self.decrease_factor)
+            self.limit = max(self.min_limit, self.limit)
+            self.condition.notify_all()
+
+
+def retry_delay(attempt: int, base: float = 2, maximum: float = 300) -> float:
+    return min(maximum, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
@@ -0,0 +1,202 @@
+import time
+import uuid
+from threading import Lock, Thread, Event
+from typing import Optional, List, Callable
+
+from checkpoint import BatchManifest
+
+
+class Coordinator:
+    def __init__(self, config: dict, batch_size=100):
+        self.start = (config["START"] // batch_size) * batch_size
+        self.end = config["END"]
+        self.batch_size = batch_size
+        self.lease_seconds = config.get("LEASE_SECONDS", 300)
+        self.lease_batches = config.get("LEASE_BATCHES", 10)
+        self.manifest = BatchManifest(config.get("MANIFEST", "coordinator_manifest.bin"), batch_size)
+        self.leases = {}
+        self.leased_batches = set()
+        self.workers = {}
+        self.cursor = self.start
+        self.lock = Lock()
+
+    def expire_leases(self):
+        now = time.time()
+        for lease_id in [x for x, lease in self.leases.items() if lease["expires"] < now]:
+            lease = self.leases.pop(lease_id)
+            self.leased_batches.difference_update(lease["batches"])
+            # Batches from the lost lease are behind the cursor, so rewind to hand them out again
+            remaining = [x for x in lease["batches"] if not self.manifest.is_complete(x)]
+            if remaining:
+                self.cursor = min(self.cursor, min(remaining))
+            print(f"Lease {lease_id} from {lease['worker']} expired, {len(remaining)} batches to reassign")
+
+    def next_batches(self) -> List[int]:
+        batches = []
+        batch_start = self.cursor
+        while batch_start < self.end and len(batches) < self.lease_batches:
+            if not self.manifest.is_complete(batch_start) and batch_start not in self.leased_batches:
+                batches.append(batch_start)
+            batch_start += self.batch_size
+        # Everything before here is now complete or leased
+        self.cursor = batch_start
+        return batches
+
+    def worker_stats(self, worker: str) -> dict:
+        if worker not in self.workers:
+            self.workers[worker] = {"first_seen": time.time(), "last_seen": time.time(), "batches": 0}
+        stats = self.workers[worker]
+        stats["last_seen"] = time.time()
+        return stats
+
+    def acquire(self, worker: str) -> dict:
+        with self.lock:
+            self.worker_stats(worker)
+            self.expire_leases()
+            batches = self.next_batches()
+            if not batches:
+                if self.leases:
+                    return {"wait": min(60, self.lease_seconds)}
+                return {"done": True}
+            lease_id = str(uuid.uuid4())
+            lease = {
+                "lease_id": lease_id,
+                "worker": worker,
+                "batches": batches,
+                "batch_size": self.batch_size,
+                "expires": time.time() + self.lease_seconds
+            }
+            self.leases[lease_id] = lease
+            self.leased_batches.update(batches)
+            return lease
+
+    def record_completed(self, lease: dict, completed: List[int]):
+        stats = self.worker_stats(lease["worker"])
+        for batch_start in completed:
+            if batch_start in lease["batches"] and not self.manifest.is_complete(batch_start):
+                self.manifest.set_bits(batch_start, True, False)
+                stats["batches"] += 1
+        self.manifest.save()
+
+    def heartbeat(self, lease_id: str, completed: List[int]) -> Optional[dict]:
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            self.record_completed(lease, completed)
+            lease["expires"] = time.time() + self.lease_seconds
+            return lease
+
+    def complete(self, lease_id: str, completed: List[int]) -> bool:
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            self.record_completed(lease, completed)
+            self.leased_batches.difference_update(lease["batches"])
+            remaining = [x for x in lease["batches"] if not self.manifest.is_complete(x)]
+            if remaining:
+                self.cursor = min(self.cursor, min(remaining))
+            return True
+
+    def status(self) -> dict:
+        with self.lock:
+            self.expire_leases()
+            workers = {}
+            for worker, stats in self.workers.items():
+                duration = max(1.0, stats["last_seen"] - stats["first_seen"])
+                workers[worker] = {
+                    "batches": stats["batches"],
+                    "ids_per_second": stats["batches"] * self.batch_size / duration,
+                    "last_seen": stats["last_seen"],
+                    "leases": len([x for x in self.leases.values() if x["worker"] == worker])
+                }
+            total_batches = max(1, -(-(self.end - self.start) // self.batch_size))
+            completed = sum(
+                1 for x in range(self.start, self.end, self.batch_size) if self.manifest.is_complete(x)
+            )
+            return {
+                "start": self.start,
+                "end": self.end,
+                "completed_batches": completed,
+                "total_batches": total_batches,
+                "active_leases": len(self.leases),
+                "workers": workers
+            }
+
+
+class LeaseClient:
+    def __init__(self, session, config: dict, user_agent: str):
+        self.session = session
+        self.url = config["URL"]
+        self.key = config["KEY"]
+        self.worker = config.get("WORKER", str(uuid.uuid4()))
+        self.heartbeat_interval = config.get("HEARTBEAT_SECONDS", 60)
+        # Runs are capped, so a lost lease is noticed between runs rather than after the whole lease
+        self.run_batches = config.get("RUN_BATCHES", 10)
+        self.user_agent = user_agent
+
+    def post(self, path: str, data: dict) -> dict:
+        headers = {"Authorization": self.key, "User-Agent": self.user_agent}
+        resp = self.session.post(self.url + path, json=data, headers=headers)
+        resp.raise_for_status()
+        return resp.json()
+
+    def acquire(self) -> Optional[dict]:
+        while True:
+            try:
+                lease = self.post("coordinator/lease", {"worker": self.worker})
+            except Exception as e:
+                print(f"Failed to get a lease from the coordinator: {e}")
+                time.sleep(30)
+                continue
+            if lease.get("done"):
+                return None
+            if "wait" in lease:
+                time.sleep(lease["wait"])
+                continue
+            return lease
+
+    def keep_alive(self, lease: dict, is_complete: Callable[[int], bool], stop: Event, lost: Event):
+        while not stop.wait(self.heartbeat_interval):
+            completed = [x for x in lease["batches"] if is_complete(x)]
+            try:
+                self.post("coordinator/heartbeat", {"lease_id": lease["lease_id"], "completed": completed})
+            except Exception as e:
+                response = getattr(e, "response", None)
+                if response is not None and response.status_code == 409:
+                    # The lease expired, and its batches may already belong to another worker
+                    print(f"Lost lease {lease['lease_id']}, stopping work on it")
+                    lost.set()
+                    return
+                print(f"Failed to send heartbeat for lease {lease['lease_id']}: {e}")
+
+    def run_lease(self, lease: dict, scrape: Callable[[int, int], None], is_complete: Callable[[int], bool]):
+        stop = Event()
+        lost = Event()
+        heartbeat = Thread(target=self.keep_alive, args=(lease, is_complete, stop, lost), daemon=True)
+        heartbeat.start()
+        try:
+            # Scrape contiguous runs of batches together
+            runs = []
+            for batch_start in sorted(lease["batches"]):
+                run_full = runs and runs[-1][1] - runs[-1][0] + 1 >= self.run_batches * lease["batch_size"]
+                if runs and runs[-1][1] == batch_start - 1 and not run_full:
+                    runs[-1][1] = batch_start + lease["batch_size"] - 1
+                else:
+                    runs.append([batch_start, batch_start + lease["batch_size"] - 1])
+            for run_start, run_end in runs:
+                if lost.is_set():
+                    break
+                scrape(run_start, run_end)
+        finally:
+            stop.set()
+            heartbeat.join()
+        if lost.is_set():
+            return
+        completed = [x for x in lease["batches"] if is_complete(x)]
+        try:
+            self.post("coordinator/complete", {"lease_id": lease["lease_id"], "completed": completed})
+        except Exception as e:
+            # The lease will expire on the coordinator, and only unfinished batches get reassigned
+            print(f"Failed to complete lease {lease['lease_id']}: {e}")
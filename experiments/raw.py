@@ -1,47 +1,42 @@
 import json
-import os
+import time
 from multiprocessing.dummy import Pool as ThreadPool
 
-import requests
+from concurrency import retry_delay
+from raw_archive import RawArchive, RETRY_STATUSES
+from sessions import SessionPool
 
+# Usage, from the repository root: python -m experiments.raw
+# Re-parse captured pages with: python raw_archive.py reparse
 with open("config.json", "r") as f:
     config = json.load(f)
-pool = ThreadPool(8)
+workers = config.get("WORKERS", 8)
+pool = ThreadPool(workers)
+http = SessionPool(workers, config.get("HTTP_POOL_PER_HOST"))
+archive = RawArchive(config.get("RAW_ARCHIVE_DIR", "raw_archive/"))
+site_url = config.get("FA_URL", "https://www.furaffinity.net")
+retries = config.get("RETRIES", 5)
 
 
 def download_page(sub_id):
-    print(f"Downloading: {sub_id}")
-    data = download_page_html(sub_id)
-    save_page(data, sub_id)
-
-
-def download_page_html(sub_id):
-    url = f"https://www.furaffinity.net/view/{sub_id}/"
-    return download_url(url)
-
-
-def download_url(url):
-    resp = requests.get(url)
-    if resp.status_code != 200:
-        return b""
-    data = resp.content
-    return data
-
-
-def make_directories(directory):
-    os.makedirs(os.path.dirname(directory), exist_ok=True)
-
-
-def save_page(page_code, sub_id):
-    filename = f"{sub_id}.html"
-    directory = f"raw/{sub_id//1000000:02}/{sub_id%1000000//10000:02}/{sub_id%10000//100:02}/"
-    make_directories(directory)
-    with open(directory + filename, "wb+") as f:
-        f.write(page_code)
+    url = f"{site_url}/view/{sub_id}/"
+    for attempt in range(retries + 1):
+        try:
+            fetch_time = time.time()
+            resp = http.get(url, cookies=config.get("LOGIN_COOKIE"))
+        except Exception as e:
+            print(f"Exception downloading submission {sub_id}: {e}")
+            time.sleep(retry_delay(attempt))
+            continue
+        # Rate limited responses are only kept if every retry was rate limited, so the status is on record
+        if resp.status_code not in RETRY_STATUSES or attempt == retries:
+            archive.write_response(sub_id, url, resp, fetch_time)
+            return
+        time.sleep(retry_delay(attempt))
+    print(f"Giving up on submission {sub_id} after {retries + 1} attempts")
 
 
 def scrape_batch(start, end):
-    full_data = dict()
     id_range = list(range(start, end+1))
     pool.map(download_page, id_range)
 
@@ -56,19 +51,7 @@ def scrape(start=1, increment=100):
         index = end + 1
 
 
-def find_latest_downloaded_id():
-    try:
-        dir_1 = str(max(int(x) for x in os.listdir("raw/"))).zfill(2)
-        dir_2 = str(max(int(x) for x in os.listdir(f"raw/{dir_1}/"))).zfill(2)
-        dir_3 = [int(x) for x in os.listdir(f"raw/{dir_1}/{dir_2}")]
-        second_biggest_dir = sorted(dir_3)[-2]
-        return second_biggest_dir*100 + 99
-    except FileNotFoundError:
-        return 0
-    except IndexError:
-        return 0
-
-
 if __name__ == "__main__":
-    largest_id = find_latest_downloaded_id()
-    scrape(largest_id+1)
+    largest_id = archive.latest_id()
+    # Pages within a batch finish out of order, so capture the latest batch again in case it was cut short
+    scrape(1 if largest_id is None else (largest_id - 1) // 100 * 100 + 1)
@@ -0,0 +1,104 @@
+import json
+import os
+import struct
+import sys
+import time
+from threading import Lock
+from typing import Dict, List, Optional
+
+RECORD = struct.Struct("<IB")
+UNKNOWN = 0
+OK = 1
+NULL = 2
+ERROR = 3
+
+
+class FetchLog:
+    def __init__(self, filename="fetch_log.bin", validators_file="fetch_validators.jsonl"):
+        self.filename = filename
+        self.validators_file = validators_file
+        # One fixed size record per ID, written in place, so the file is sparse over unscraped ranges
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.validators = None
+        self.lock = Lock()
+
+    def record(self, sub_id: int, outcome: int, fetch_time: float = None, validators: Optional[dict] = None):
+        if fetch_time is None:
+            fetch_time = time.time()
+        os.pwrite(self.fd, RECORD.pack(int(fetch_time), outcome), sub_id * RECORD.size)
+        if validators:
+            with self.lock:
+                with open(self.validators_file, "a") as f:
+                    f.write(json.dumps({"id": sub_id, **validators}) + "\n")
+                if self.validators is not None:
+                    self.validators[sub_id] = validators
+
+    def read_range(self, start: int, end: int) -> List[tuple]:
+        data = os.pread(self.fd, (end - start + 1) * RECORD.size, start * RECORD.size)
+        # Past the end of the file, IDs have never been fetched
+        data += bytes((end - start + 1) * RECORD.size - len(data))
+        return list(RECORD.iter_unpack(data))
+
+    def get(self, sub_id: int) -> tuple:
+        return self.read_range(sub_id, sub_id)[0]
+
+    def stale_ids(self, start: int, end: int, max_age: float, now: float = None) -> List[int]:
+        if now is None:
+            now = time.time()
+        stale = []
+        for position, (fetch_time, outcome) in enumerate(self.read_range(start, end)):
+            if outcome != OK or now - fetch_time > max_age:
+                stale.append(start + position)
+        return stale
+
+    def load_validators(self) -> Dict[int, dict]:
+        with self.lock:
+            if self.validators is not None:
+                return self.validators
+            validators = {}
+            try:
+                with open(self.validators_file, "r") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        validators[entry.pop("id")] = entry
+            except FileNotFoundError:
+                pass
+            self.validators = validators
+            return validators
+
+    def validators_for(self, sub_id: int) -> Optional[dict]:
+        return self.load_validators().get(sub_id)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def seed_from_batches(data_dir="data/", filename="fetch_log.bin"):
+    # Batches scraped before fetches were logged take the batch file's modification time as their fetch time
+    from scan import batch_files
+    log = FetchLog(filename)
+    count = 0
+    for batch_file in batch_files(data_dir):
+        fetch_time = os.path.getmtime(batch_file)
+        with open(batch_file, "r") as f:
+            full_data = json.load(f)
+        for key, entry in full_data.items():
+            if log.get(int(key))[1] != UNKNOWN:
+                continue
+            log.record(int(key), NULL if entry is None else OK, fetch_time)
+        count += 1
+    log.close()
+    print(f"Seeded fetch log from {count} batch files")
+
+
+if __name__ == "__main__":
+    # Usage: python fetch_log.py seed [data dir]
+    # or: python fetch_log.py stale <start> <end> <max age in days>
+    if sys.argv[1] == "seed":
+        seed_from_batches(*sys.argv[2:3])
+    elif sys.argv[1] == "stale":
+        stale_ids = FetchLog().stale_ids(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]) * 86400)
+        print(f"{len(stale_ids)} stale submissions")
@@ -0,0 +1,122 @@
+import fcntl
+import glob
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import List
+
+from search_index import (
+    INDEX_DIR, SearchIndex, index_records, read_manifest, write_manifest, write_segment, compact, remove_segments
+)
+
+
+class IndexUpdater:
+    def __init__(self, search_index: SearchIndex, flush_interval: float = 2, max_deltas: int = 8):
+        self.search_index = search_index
+        self.index_dir = search_index.index_dir
+        self.wal_file = os.path.join(self.index_dir, "wal.jsonl")
+        self.wal_lock_file = os.path.join(self.index_dir, "wal.lock")
+        self.flush_interval = flush_interval
+        self.max_deltas = max_deltas
+        self.lock = Lock()
+        self.thread = Thread(target=self.run, daemon=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def start(self):
+        self.thread.start()
+
+    def append(self, path: str, batch: dict):
+        self.append_line(path, json.dumps(batch))
+
+    @contextmanager
+    def wal_lock(self):
+        # Server workers and a standalone updater are separate processes, so the thread lock alone can't stop an append
+        # landing in a log which has already been moved aside and read
+        with self.lock:
+            with open(self.wal_lock_file, "a") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def append_line(self, path: str, batch_json: str):
+        line = '{"path": ' + json.dumps(path) + ', "batch": ' + batch_json + '}\n'
+        with self.wal_lock():
+            with open(self.wal_file, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def run(self):
+        while True:
+            try:
+                self.flush()
+                self.compact()
+            except Exception as e:
+                print(f"Failed to update search index: {e}")
+            time.sleep(self.flush_interval)
+
+    def flush(self):
+        # Move the log aside, so uploads carry on into a new one while this is indexed
+        with self.wal_lock():
+            if os.path.exists(self.wal_file) and os.path.getsize(self.wal_file) > 0:
+                os.replace(self.wal_file, os.path.join(self.index_dir, f"wal-{time.time_ns()}.flushing"))
+        for flushing_file in sorted(glob.glob(os.path.join(self.index_dir, "wal-*.flushing"))):
+            self.apply_log(flushing_file)
+            os.remove(flushing_file)
+
+    def read_log(self, log_file: str) -> List[dict]:
+        batches = {}
+        with open(log_file, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # Appends hold the log lock until the whole line is written, so only a crash leaves one cut short
+                    print(f"Skipping partly written entry at the end of {log_file}")
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print(f"Skipping unreadable entry in {log_file}")
+                    continue
+                # A later upload of the same path replaces the earlier one
+                batches[entry["path"]] = entry["batch"]
+        return list(batches.values())
+
+    def apply_log(self, log_file: str):
+        batches = self.read_log(log_file)
+        records = []
+        covered = []
+        for batch in batches:
+            sub_ids = [int(x) for x in batch.keys()]
+            if not sub_ids:
+                continue
+            covered.append([min(sub_ids), max(sub_ids)])
+            records.extend(batch[key] for key in sorted(batch, key=int) if batch[key] is not None)
+        records.sort(key=lambda x: x["id"])
+        postings, doc_ids, doc_dates = index_records(records)
+        manifest = read_manifest(self.index_dir)
+        name = f"delta-{manifest['next_segment']}"
+        write_segment(os.path.join(self.index_dir, name), postings, doc_ids, doc_dates, covered)
+        manifest["segments"].append(name)
+        manifest["next_segment"] += 1
+        write_manifest(self.index_dir, manifest)
+        self.search_index.load()
+
+    def compact(self):
+        manifest = read_manifest(self.index_dir)
+        if len([x for x in manifest["segments"] if x.startswith("delta-")]) <= self.max_deltas:
+            return
+        merged = compact(self.index_dir)
+        self.search_index.load()
+        remove_segments(self.index_dir, merged)
+
+
+if __name__ == "__main__":
+    # Run the updater on its own, for servers started with several WSGI workers
+    index_dir = sys.argv[1] if len(sys.argv) > 1 else INDEX_DIR
+    updater = IndexUpdater(SearchIndex(index_dir))
+    updater.run()
@@ -1,20 +1,37 @@
-import glob
 import json
+import sys
 
-files = glob.glob("D:/fa-indexer/data/*/*/*.json")
-users = set()
-total_files = len(files)
-count = 0
-for file in files:
-    with open(file, "r") as f:
-        d = json.load(f)
+from scan import scan_records
+from secondary_index import INDEX_DIR, SecondaryIndex
+
+
+def users_from_index(index: SecondaryIndex):
+    return [index.username_at(x) for x in range(index.user_count)]
+
+
+def users_from_scan(data_dir: str):
+    users = set()
+    count = 0
+    for record in scan_records(data_dir, fields=["username"]):
+        users.add(record["username"])
         count += 1
-    for key in d.keys():
-        sub = d[key]
-        if sub is not None:
-            users.add(sub["username"])
-    print(f"Done {count} files of {total_files}. So far, {len(users)} users. Current file: {file}")
-
-print(f"total of {len(users)} users")
-with open("users.json", "w") as f:
-    json.dump(sorted(list(users)), f)
+        if count % 1000000 == 0:
+            print(f"Scanned {count} submissions. So far, {len(users)} users.")
+    return sorted(list(users))
+
+
+if __name__ == "__main__":
+    # Usage: python list_users.py [data dir]
+    index = SecondaryIndex(INDEX_DIR)
+    # The secondary index already holds the sorted usernames, so only scan when it hasn't been built, or when a data
+    # directory is given, since the index may have been built from a different one
+    if len(sys.argv) > 1:
+        user_list = users_from_scan(sys.argv[1])
+    elif index.meta_mtime is not None:
+        user_list = users_from_index(index)
+    else:
+        user_list = users_from_scan("data/")
+
+    print(f"total of {len(user_list)} users")
+    with open("users.json", "w") as f:
+        json.dump(user_list, f)
@@ -0,0 +1,161 @@
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Event
+from typing import Callable, Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            bucket_labels = f'{labels},le="{bound}"' if labels else f'le="{bound}"'
+            lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+        label_text = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{label_text} {self.sum}")
+        lines.append(f"{name}_count{label_text} {self.count}")
+        return lines
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges: List[Callable[[], Dict[str, float]]] = []
+        self.block_start = None
+        self.block_end = None
+        self.ids_done = 0
+        self.ids_skipped = 0
+        self.started = time.monotonic()
+        self.recent: List[Tuple[float, int]] = []
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, format_labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(LATENCY_BUCKETS)
+            self.histograms[key].observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, format_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauges(self, collector: Callable[[], Dict[str, float]]):
+        self.gauges.append(collector)
+
+    def set_block(self, start: int, end: Optional[int]):
+        self.block_start = start
+        self.block_end = end
+
+    def batch_done(self, size: int, skipped: bool = False):
+        with self.lock:
+            self.ids_done += size
+            if skipped:
+                self.ids_skipped += size
+            else:
+                self.recent.append((time.monotonic(), size))
+
+    def rate(self, window: float = 300) -> float:
+        now = time.monotonic()
+        with self.lock:
+            self.recent = [x for x in self.recent if x[0] > now - window]
+            ids = sum(x[1] for x in self.recent)
+        duration = min(window, now - self.started)
+        return ids / duration if duration > 0 else 0
+
+    def eta(self) -> Optional[float]:
+        if self.block_end is None or self.block_start is None:
+            return None
+        rate = self.rate()
+        if rate == 0:
+            return None
+        return max(0, (self.block_end - self.block_start) - self.ids_done) / rate
+
+    def counter_total(self, name: str) -> float:
+        with self.lock:
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.extend(histogram.render(name, labels))
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}{label_text} {value}")
+        lines.append(f"fa_indexer_ids_done {self.ids_done}")
+        lines.append(f"fa_indexer_ids_per_second {self.rate()}")
+        eta = self.eta()
+        if eta is not None:
+            lines.append(f"fa_indexer_eta_seconds {eta}")
+        for collector in self.gauges:
+            for name, value in collector().items():
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def start_summary(self, interval: float, extra: Callable[[], str]) -> Event:
+        stop = Event()
+
+        def report():
+            while not stop.wait(interval):
+                print(self.summary() + extra())
+
+        Thread(target=report, daemon=True).start()
+        return stop
+
+    def summary(self) -> str:
+        line = f"{self.ids_done} IDs done, {self.rate():.2f} IDs/sec"
+        eta = self.eta()
+        if eta is not None:
+            line += f", ETA {format_seconds(eta)}"
+        return line
+
+
+def format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d{hours:02}h{minutes:02}m"
+    return f"{hours}h{minutes:02}m{seconds:02}s"
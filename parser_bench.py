@@ -0,0 +1,93 @@
+import glob
+import sys
+import time
+
+from parsers import BACKENDS, HTMLParser, LXML_AVAILABLE, parse_website_page, parse_archive_page
+
+# Usage: python parser_bench.py <website|archive> "<glob of sample html pages>"
+
+
+def read_page(filename, page_type):
+    if page_type == "website":
+        with open(filename, "rb") as f:
+            return f.read()
+    for encoding in ["utf-8", "cp1252", "cp850"]:
+        try:
+            with open(filename, "r", encoding=encoding) as f:
+                return f.read()
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def parse(html, page_type, backend):
+    if page_type == "website":
+        return parse_website_page(html, backend)
+    return parse_archive_page(html, backend)
+
+
+def available_backends():
+    backends = ["html.parser"]
+    if LXML_AVAILABLE:
+        backends.append("lxml")
+    if HTMLParser is not None:
+        backends.append("selectolax")
+    return [x for x in BACKENDS if x in backends]
+
+
+def run_backend(pages, page_type, backend):
+    results = {}
+    errors = 0
+    start_time = time.perf_counter()
+    for filename, html in pages.items():
+        try:
+            results[filename] = parse(html, page_type, backend)
+        except Exception as e:
+            results[filename] = e
+            errors += 1
+    duration = time.perf_counter() - start_time
+    return results, duration, errors
+
+
+def compare(reference, results, page_type):
+    mismatches = {}
+    for filename, expected in reference.items():
+        actual = results[filename]
+        if isinstance(expected, Exception) or isinstance(actual, Exception):
+            if type(expected) != type(actual):
+                mismatches[filename] = ["exception"]
+            continue
+        if page_type == "website":
+            expected = expected[0]
+            actual = actual[0]
+        if expected is None or actual is None:
+            if expected != actual:
+                mismatches[filename] = ["missing"]
+            continue
+        fields = [key for key in expected if expected[key] != actual.get(key)]
+        if fields:
+            mismatches[filename] = fields
+    return mismatches
+
+
+if __name__ == "__main__":
+    page_type = sys.argv[1]
+    files = sorted(glob.glob(sys.argv[2], recursive=True))
+    pages = {}
+    for file in files:
+        page = read_page(file, page_type)
+        if page is not None:
+            pages[file] = page
+    print(f"Loaded {len(pages)} {page_type} pages")
+    reference = None
+    for backend in available_backends():
+        results, duration, errors = run_backend(pages, page_type, backend)
+        rate = len(pages) / duration if duration else 0
+        print(f"{backend}: {rate:.1f} pages/sec, {errors} errors")
+        if reference is None:
+            reference = results
+            continue
+        mismatches = compare(reference, results, page_type)
+        print(f"{backend}: {len(mismatches)} pages differ from html.parser output")
+        for filename, fields in list(mismatches.items())[:20]:
+            print(f"  {filename}: {', '.join(fields)}")
@@ -0,0 +1,209 @@
+import re
+from typing import Optional, Tuple
+
+import dateutil.parser as parser
+from bs4 import BeautifulSoup
+
+try:
+    # The Modest based selectolax.parser module is gone from selectolax 1.0, while the Lexbor one is there since 0.3
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+BACKENDS = ["selectolax", "lxml", "html.parser"]
+BR_TAG = re.compile(r"<br\s*/?>", re.I)
+# FA answers a removed submission with a 200 system message page instead of a 404
+MISSING_SUBMISSION = re.compile(rb"submission you are trying to find is not in our database", re.I)
+
+
+def resolve_backend(backend: str = "auto") -> str:
+    # lxml repairs broken markup differently to html.parser, so descriptions can come out different, and it is only used
+    # when asked for by name. Run parser_bench.py to compare backends on saved pages first
+    if backend == "selectolax" and HTMLParser is not None:
+        return backend
+    if backend == "lxml" and LXML_AVAILABLE:
+        return "lxml"
+    if backend not in ["auto", "html.parser"]:
+        print(f"Parser backend {backend} is not installed, using html.parser")
+    return "html.parser"
+
+
+def is_missing_page(html) -> bool:
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    return MISSING_SUBMISSION.search(html) is not None
+
+
+def soup_features(backend: str) -> str:
+    if backend == "lxml" and LXML_AVAILABLE:
+        return "lxml"
+    return "html.parser"
+
+
+def read_registered(footer_html: str) -> Optional[int]:
+    reg_users = re.search(r"([0-9]+)\s*<b>registered", footer_html, re.I)
+    if reg_users is None:
+        return None
+    return int(reg_users.group(1))
+
+
+def parse_website_page(html, backend: str) -> Tuple[Optional[dict], Optional[int]]:
+    if backend == "selectolax" and HTMLParser is not None:
+        try:
+            return fast_website_page(html)
+        except Exception:
+            # Anything the targeted extractor doesn't understand gets the full parse
+            backend = "html.parser"
+    return soup_website_page(html, backend)
+
+
+def parse_archive_page(html, backend: str) -> Optional[dict]:
+    if backend == "selectolax" and HTMLParser is not None:
+        try:
+            return fast_archive_page(html)
+        except Exception:
+            backend = "html.parser"
+    return soup_archive_page(html, backend)
+
+
+def soup_website_page(html, backend: str) -> Tuple[Optional[dict], Optional[int]]:
+    soup = BeautifulSoup(html, soup_features(backend))
+    main_tables = soup.select('div#page-submission table.maintable table.maintable')
+    if len(main_tables) == 0:
+        return None, None
+    main_table = main_tables[-1]
+
+    title_bar = main_table.select_one('.classic-submission-title.container')
+    stats_container = main_table.select_one('td.alt1.stats-container')
+    actions_bar = soup.select_one('#page-submission div.actions')
+
+    username = title_bar.select_one('.information a')['href'].strip("/").split("/")[-1]
+    title = title_bar.select_one('h2').text
+    description = main_table.find_all('tr')[-1].find('td').decode_contents().strip()
+    keywords = [x.text for x in stats_container.select('div#keywords a')]
+    date = parser.parse(stats_container.select_one('.popup_date')['title']).isoformat()
+    rating_img = stats_container.select_one('img')
+    if rating_img is None:
+        rating = "General"
+    else:
+        rating = rating_img['alt'].replace(' rating', '')
+    filename = "https:" + [x['href'] for x in actions_bar.select('a') if x.text == "Download"][0]
+
+    reg_count = read_registered(soup.select_one(".footer center").decode_contents())
+    return {
+        "username": username,
+        "title": title,
+        "description": description,
+        "keywords": keywords,
+        "date": date,
+        "rating": rating,
+        "filename": filename
+    }, reg_count
+
+
+def soup_archive_page(html, backend: str) -> Optional[dict]:
+    soup = BeautifulSoup(html, soup_features(backend))
+    main_table = soup.select_one('table.maintable table.maintable table.maintable')
+    if main_table is None:
+        return None
+
+    title_bar = main_table.select_one('td.cat')
+    stats_container = main_table.select_one('td.alt1 td.alt1')
+    actions_bar = soup.select_one('div.actions')
+
+    username = title_bar.select_one('a')['href'].strip("/").split("/")[-1]
+    title = title_bar.select_one('b').text
+    description_raw = main_table.find_all('tr')[-1].find('td').decode_contents().strip()
+    description = "<br/>".join(description_raw.split("<br/>")[2:]).strip()
+    keywords = [x.text for x in stats_container.select('div#keywords a')]
+    date = parser.parse(stats_container.select_one('.popup_date').text).isoformat()
+    rating = stats_container.select_one('img')['alt'].replace(' rating', '')
+    filename = "https:" + [x['href'] for x in actions_bar.select('a') if x.text.strip() == "Download"][0]
+    return {
+        "username": username,
+        "title": title,
+        "description": description,
+        "keywords": keywords,
+        "date": date,
+        "rating": rating,
+        "filename": filename
+    }
+
+
+def inner_html(node) -> str:
+    # Strip the node's own opening and closing tags, and match BeautifulSoup's <br/> output
+    html = node.html
+    contents = html[html.index(">") + 1:html.rindex("<")]
+    return BR_TAG.sub("<br/>", contents)
+
+
+def fast_website_page(html) -> Tuple[Optional[dict], Optional[int]]:
+    tree = HTMLParser(html)
+    main_tables = tree.css('div#page-submission table.maintable table.maintable')
+    if len(main_tables) == 0:
+        return None, None
+    main_table = main_tables[-1]
+
+    title_bar = main_table.css_first('.classic-submission-title.container')
+    stats_container = main_table.css_first('td.alt1.stats-container')
+    actions_bar = tree.css_first('#page-submission div.actions')
+
+    username = title_bar.css_first('.information a').attributes['href'].strip("/").split("/")[-1]
+    title = title_bar.css_first('h2').text()
+    description = inner_html(main_table.css('tr')[-1].css_first('td')).strip()
+    keywords = [x.text() for x in stats_container.css('div#keywords a')]
+    date = parser.parse(stats_container.css_first('.popup_date').attributes['title']).isoformat()
+    rating_img = stats_container.css_first('img')
+    if rating_img is None:
+        rating = "General"
+    else:
+        rating = rating_img.attributes['alt'].replace(' rating', '')
+    filename = "https:" + [x.attributes['href'] for x in actions_bar.css('a') if x.text() == "Download"][0]
+
+    reg_count = read_registered(inner_html(tree.css_first('.footer center')))
+    return {
+        "username": username,
+        "title": title,
+        "description": description,
+        "keywords": keywords,
+        "date": date,
+        "rating": rating,
+        "filename": filename
+    }, reg_count
+
+
+def fast_archive_page(html) -> Optional[dict]:
+    tree = HTMLParser(html)
+    main_table = tree.css_first('table.maintable table.maintable table.maintable')
+    if main_table is None:
+        return None
+
+    title_bar = main_table.css_first('td.cat')
+    stats_container = main_table.css_first('td.alt1 td.alt1')
+    actions_bar = tree.css_first('div.actions')
+
+    username = title_bar.css_first('a').attributes['href'].strip("/").split("/")[-1]
+    title = title_bar.css_first('b').text()
+    description_raw = inner_html(main_table.css('tr')[-1].css_first('td')).strip()
+    description = "<br/>".join(description_raw.split("<br/>")[2:]).strip()
+    keywords = [x.text() for x in stats_container.css('div#keywords a')]
+    date = parser.parse(stats_container.css_first('.popup_date').text()).isoformat()
+    rating = stats_container.css_first('img').attributes['alt'].replace(' rating', '')
+    filename = "https:" + [
+        x.attributes['href'] for x in actions_bar.css('a') if x.text().strip() == "Download"
+    ][0]
+    return {
+        "username": username,
+        "title": title,
+        "description": description,
+        "keywords": keywords,
+        "date": date,
+        "rating": rating,
+        "filename": filename
+    }
@@ -0,0 +1,216 @@
+import glob
+import json
+import os
+import struct
+import sys
+import zlib
+from multiprocessing import Pool
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+from atomic_file import write_atomic
+from segment_store import SegmentStore
+
+RECORD = struct.Struct("<II")
+INDEX_ENTRY = struct.Struct("<qqq")
+ARCHIVE_BYTES = 1024 * 1024 * 1024
+REPARSE_CHUNK = 500
+# Pages with these statuses were never really captured, so re-parsing leaves them out
+RETRY_STATUSES = [429, 503]
+# Statuses which say the submission itself is gone, rather than the fetch failing
+GONE_STATUSES = [404, 410]
+
+
+class RawArchive:
+    def __init__(self, root="raw_archive/", max_bytes: int = ARCHIVE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.archive_num = None
+        self.dat = None
+        self.idx = None
+        self.lock = Lock()
+
+    def archive_files(self, archive_num: int) -> Tuple[str, str]:
+        prefix = os.path.join(self.root, f"raw-{archive_num:05}")
+        return prefix + ".dat", prefix + ".idx"
+
+    def archives(self) -> List[int]:
+        return sorted(int(os.path.basename(x)[4:-4]) for x in glob.glob(os.path.join(self.root, "raw-*.idx")))
+
+    def roll(self):
+        self.close_files()
+        archives = self.archives()
+        # Each run starts a fresh archive, so a record cut short by a crash is never appended to
+        self.archive_num = archives[-1] + 1 if archives else 0
+        dat_file, idx_file = self.archive_files(self.archive_num)
+        self.dat = open(dat_file, "ab")
+        self.idx = open(idx_file, "ab")
+
+    def encode_record(self, sub_id: int, url: str, status: int, headers: dict, fetch_time: float, body: bytes) -> bytes:
+        meta = json.dumps({
+            "id": sub_id,
+            "url": url,
+            "status": status,
+            "headers": headers,
+            "time": fetch_time
+        }).encode("utf-8")
+        compressed = zlib.compress(body, 6)
+        return RECORD.pack(len(meta), len(compressed)) + meta + compressed
+
+    def write(self, sub_id: int, url: str, status: int, headers: dict, fetch_time: float, body: bytes):
+        record = self.encode_record(sub_id, url, status, headers, fetch_time, body)
+        with self.lock:
+            if self.dat is None or self.dat.tell() >= self.max_bytes:
+                self.roll()
+            offset = self.dat.tell()
+            self.dat.write(record)
+            self.dat.flush()
+            # Only index the record once it has been written
+            self.idx.write(INDEX_ENTRY.pack(sub_id, offset, len(record)))
+            self.idx.flush()
+
+    def write_response(self, sub_id: int, url: str, resp, fetch_time: float):
+        self.write(sub_id, url, resp.status_code, dict(resp.headers), fetch_time, resp.content)
+
+    def read_index(self, archive_num: int) -> List[Tuple[int, int, int]]:
+        _, idx_file = self.archive_files(archive_num)
+        with open(idx_file, "rb") as f:
+            index_data = f.read()
+        # Ignore an entry which was only partly written
+        index_data = index_data[:len(index_data) - len(index_data) % INDEX_ENTRY.size]
+        return list(INDEX_ENTRY.iter_unpack(index_data))
+
+    def latest_id(self) -> Optional[int]:
+        latest = None
+        for archive_num in self.archives():
+            for sub_id, _, _ in self.read_index(archive_num):
+                latest = sub_id if latest is None else max(latest, sub_id)
+        return latest
+
+    def close_files(self):
+        for f in [self.dat, self.idx]:
+            if f is not None:
+                f.close()
+        self.dat = None
+        self.idx = None
+
+    def close(self):
+        with self.lock:
+            self.close_files()
+
+
+def decode_record(record: bytes) -> Tuple[dict, bytes]:
+    meta_length, body_length = RECORD.unpack_from(record)
+    meta = json.loads(record[RECORD.size:RECORD.size + meta_length].decode("utf-8"))
+    body = zlib.decompress(record[RECORD.size + meta_length:RECORD.size + meta_length + body_length])
+    return meta, body
+
+
+def iter_records(dat_file: str, entries: List[Tuple[int, int, int]]) -> Iterator[Tuple[dict, bytes]]:
+    with open(dat_file, "rb") as f:
+        for _, offset, length in entries:
+            f.seek(offset)
+            yield decode_record(f.read(length))
+
+
+def parse_record(meta: dict, body: bytes, backend: str) -> Optional[dict]:
+    # Imported here so capture doesn't need the scraper's dependencies
+    from run import WebsiteDownloader
+    if meta["status"] in GONE_STATUSES:
+        return None
+    downloader = WebsiteDownloader(meta["id"], {}, parser_backend=backend)
+    result = downloader.parse_page(body)
+    if result is None and not downloader.deleted:
+        # Only a page saying the submission is gone may replace saved data with null
+        raise ValueError("Page could not be parsed")
+    return None if result is None else result.to_dict()
+
+
+def parse_chunk(args: Tuple[str, List[Tuple[int, int, int]], str]) -> List[Tuple[int, Optional[dict]]]:
+    dat_file, entries, backend = args
+    results = []
+    for meta, body in iter_records(dat_file, entries):
+        # Other failed captures, such as a 403 or a 5xx, are left out like the retried ones
+        if meta["status"] != 200 and meta["status"] not in GONE_STATUSES:
+            continue
+        try:
+            results.append((meta["id"], parse_record(meta, body, backend)))
+        except Exception as e:
+            print(f"Could not parse captured submission {meta['id']}: {e}")
+    return results
+
+
+def merge_batch(saved: dict, parsed: dict) -> dict:
+    full_data = dict(saved)
+    full_data.update(parsed)
+    return {key: full_data[key] for key in sorted(full_data, key=int)}
+
+
+def save_parsed_batch(store: Optional[SegmentStore], data_dir: str, batch_start: int, batch_size: int, parsed: dict):
+    # The archive may only hold some of a batch's pages, so parsed entries are merged into what is already saved
+    if store is not None:
+        store.save_batch(batch_start, merge_batch(store.load_batch(batch_start) or {}, parsed))
+        return
+    batch_end = batch_start + batch_size
+    directory = os.path.join(data_dir, f"{batch_start//1000000:02}", f"{batch_start%1000000//10000:02}")
+    filename = os.path.join(directory, f"batch-{batch_start:08}-{batch_end:08}.json")
+    os.makedirs(directory, exist_ok=True)
+    saved = {}
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            saved = json.load(f)
+    write_atomic(filename, json.dumps(merge_batch(saved, parsed)).encode())
+
+
+def reparse(
+        root="raw_archive/",
+        data_dir="data/",
+        segment_dir: str = None,
+        backend: str = "auto",
+        processes: int = None,
+        batch_size: int = 100
+):
+    from parsers import resolve_backend
+    backend = resolve_backend(backend)
+    archive = RawArchive(root)
+    store = SegmentStore(segment_dir, batch_size) if segment_dir is not None else None
+    jobs = []
+    pending = {}
+    for archive_num in archive.archives():
+        dat_file, _ = archive.archive_files(archive_num)
+        entries = archive.read_index(archive_num)
+        for sub_id, _, _ in entries:
+            batch_start = (sub_id // batch_size) * batch_size
+            pending[batch_start] = pending.get(batch_start, 0) + 1
+        jobs += [(dat_file, entries[i:i + REPARSE_CHUNK], backend) for i in range(0, len(entries), REPARSE_CHUNK)]
+    batches = {}
+    saved = 0
+    with Pool(processes) as pool:
+        # Chunks come back in order, so a page captured more than once takes its latest capture
+        for (_, entries, _), results in zip(jobs, pool.imap(parse_chunk, jobs)):
+            for sub_id, result in results:
+                batch_start = (sub_id // batch_size) * batch_size
+                batches.setdefault(batch_start, {})[str(sub_id)] = result
+            for sub_id, _, _ in entries:
+                batch_start = (sub_id // batch_size) * batch_size
+                pending[batch_start] -= 1
+                # Write each batch as soon as every capture in it has been parsed
+                if pending[batch_start] == 0:
+                    full_data = batches.pop(batch_start, None)
+                    if full_data:
+                        save_parsed_batch(store, data_dir, batch_start, batch_size, full_data)
+                        saved += 1
+    print(f"Re-parsed {sum(len(x[1]) for x in jobs)} captured pages into {saved} batches")
+
+
+if __name__ == "__main__":
+    # Usage: python raw_archive.py reparse [raw archive dir] [data dir] [segment dir]
+    # Set PARSER and PROCESSES in the environment to choose the parser backend and pool size
+    if sys.argv[1] == "reparse":
+        args = sys.argv[2:5]
+        reparse(
+            *args,
+            backend=os.environ.get("PARSER", "auto"),
+            processes=int(os.environ["PROCESSES"]) if "PROCESSES" in os.environ else None
+        )
@@ -1,24 +1,46 @@
 import datetime
 import json
 import os
-import re
+import sys
 import time
 from abc import ABC
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing.dummy import Pool as ThreadPool
-from threading import RLock
-from typing import Union, List, Optional
+from collections import OrderedDict
+from threading import Lock, Event
+from typing import Union, List, Optional, Tuple
 import dateutil.parser as parser
-from bs4 import BeautifulSoup
 import glob
+from bisect import bisect_right
 
 import requests
 
+from archive_index import ArchiveIndex
+from checkpoint import BatchManifest
+from concurrency import ConcurrencyController, RateLimitedError, retry_delay
+from coordinator import LeaseClient
+from fetch_log import FetchLog, OK, NULL, ERROR
+from metrics import Metrics
+from parsers import is_missing_page, parse_website_page, parse_archive_page, resolve_backend
+from segment_store import SegmentStore
+from sessions import SessionPool
+from tracing import Tracer, NULL_TRACER
+from uploader import Uploader
+
 VERSION = "0.2.0"
 USER_AGENT = f"FA indexer, trying to create a more efficient FA search function. " \
              f"Contact fa-index@spangle.org.uk, @deerspangle on telegram, or dr-spangle on FA. Version {VERSION}"
 
 
+def intern_string(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
 class PageResult:
+    __slots__ = ["sub_id", "username", "title", "description", "keywords", "date", "rating", "filename"]
+
     def __init__(
             self,
             sub_id: int,
@@ -31,12 +53,13 @@ class PageResult:
             filename: str
     ):
         self.sub_id = sub_id
-        self.username = username
+        # Usernames, ratings and keywords repeat across the corpus, so each is only held in memory once
+        self.username = intern_string(username)
         self.title = title
         self.description = description
-        self.keywords = keywords
+        self.keywords = None if keywords is None else [intern_string(x) for x in keywords]
         self.date = date
-        self.rating = rating
+        self.rating = intern_string(rating)
         self.filename = filename
 
     def __repr__(self):
@@ -55,7 +78,39 @@ class PageResult:
         }
 
 
+def conditional_headers(validators: Optional[dict]) -> dict:
+    headers = {}
+    if validators is None:
+        return headers
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(resp) -> Optional[dict]:
+    validators = {}
+    if "ETag" in resp.headers:
+        validators["etag"] = resp.headers["ETag"]
+    if "Last-Modified" in resp.headers:
+        validators["last_modified"] = resp.headers["Last-Modified"]
+    return validators or None
+
+
 class PageGetter(ABC):
+    cpu_bound = False
+    network = False
+    bytes_received = 0
+    parse_seconds = 0.0
+    # Set when a conditional request finds the page unchanged since it was last fetched
+    not_modified = False
+    validators = None
+    failed = False
+    # Set only when the site confirms the submission is gone, rather than the fetch just coming back empty
+    deleted = False
+    tracer = NULL_TRACER
+
     def result(self) -> Optional[PageResult]:
         raise NotImplementedError()
 
@@ -64,110 +119,185 @@ class PageGetter(ABC):
 
 
 class WebsiteDownloader(PageGetter):
-    def __init__(self, sub_id: int, login_cookie: dict):
+    network = True
+
+    def __init__(
+            self,
+            sub_id: int,
+            login_cookie: dict,
+            session=requests,
+            parser_backend: str = "html.parser",
+            site_url: str = "http://furaffinity.net",
+            conditional: Optional[dict] = None
+    ):
         self.sub_id = sub_id
         self.login_cookie = login_cookie
+        self.session = session
+        self.parser_backend = parser_backend
+        self.site_url = site_url
+        self.conditional = conditional
         self.over_10k_registered = False
 
     def download_page(self):
-        resp = requests.get(
-            f"http://furaffinity.net/view/{self.sub_id}",
+        resp = self.session.get(
+            f"{self.site_url}/view/{self.sub_id}",
             cookies=self.login_cookie,
-            headers={"User-Agent": USER_AGENT}
+            headers={"User-Agent": USER_AGENT, **conditional_headers(self.conditional)}
         )
+        self.bytes_received += len(resp.content)
+        if resp.status_code == 304 and self.conditional is not None:
+            self.not_modified = True
+            return None
         if resp.status_code == 200:
+            self.validators = response_validators(resp)
             return resp.content
+        if resp.status_code in [429, 503]:
+            raise RateLimitedError(resp.status_code, f"FA is rate limiting us. ({resp.status_code})")
         raise Exception(f"Did not receive 200 response from FA. ({resp.status_code})")
 
-    def read_status(self, soup):
-        footer = soup.select_one(".footer center").decode_contents()
-        reg_users = re.search(r"([0-9]+)\s*<b>registered", footer, re.I)
-        if reg_users is not None:
-            reg_count = int(reg_users.group(1))
-            if reg_count > 10000:
-                self.over_10k_registered = True
+    def read_status(self, reg_count: Optional[int]):
+        if reg_count is not None and reg_count > 10000:
+            self.over_10k_registered = True
 
     def result(self) -> Optional[PageResult]:
-        html = self.download_page()
-        soup = BeautifulSoup(html, "html.parser")
-        main_tables = soup.select('div#page-submission table.maintable table.maintable')
-        if len(main_tables) == 0:
+        with self.tracer.span("download_page"):
+            html = self.download_page()
+        if self.not_modified:
+            return None
+        return self.parse_page(html)
+
+    def parse_page(self, html) -> Optional[PageResult]:
+        start_time = time.perf_counter()
+        with self.tracer.span("parse_page"):
+            fields, reg_count = parse_website_page(html, self.parser_backend)
+        self.parse_seconds += time.perf_counter() - start_time
+        if fields is None:
             self.over_10k_registered = None
+            self.deleted = is_missing_page(html)
             return None
-        main_table = main_tables[-1]
-
-        title_bar = main_table.select_one('.classic-submission-title.container')
-        stats_container = main_table.select_one('td.alt1.stats-container')
-        actions_bar = soup.select_one('#page-submission div.actions')
-
-        username = title_bar.select_one('.information a')['href'].strip("/").split("/")[-1]
-        title = title_bar.select_one('h2').text
-        description = main_table.select('tr')[-1].select_one('td').decode_contents().strip()
-        keywords = [x.text for x in stats_container.select('div#keywords a')]
-        date = parser.parse(stats_container.select_one('.popup_date')['title']).isoformat()
-        rating_img = stats_container.select_one('img')
-        if rating_img is None:
-            rating = "General"
-        else:
-            rating = stats_container.select_one('img')['alt'].replace(' rating', '')
-        filename = "https:" + [x['href'] for x in actions_bar.select('a') if x.text == "Download"][0]
-
-        self.read_status(soup)
-
-        return PageResult(
-            self.sub_id,
-            username,
-            title,
-            description,
-            keywords,
-            date,
-            rating,
-            filename
-        )
+        self.read_status(reg_count)
+        return PageResult(self.sub_id, **fields)
 
     def should_slow_down(self):
         return self.over_10k_registered
 
 
+class StatusCache:
+    def __init__(self, ttl: float = 5):
+        self.ttl = ttl
+        self.entries = {}
+        self.loader_locks = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, base_url):
+        with self.lock:
+            entry = self.entries.get(base_url)
+            if entry is None or time.monotonic() - entry["time"] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry["status"]
+
+    def store(self, base_url, status):
+        with self.lock:
+            self.entries[base_url] = {"time": time.monotonic(), "status": status}
+
+    def get(self, base_url, loader):
+        status = self.cached(base_url)
+        if status is not None:
+            return status
+        with self.lock:
+            loader_lock = self.loader_locks.setdefault(base_url, Lock())
+        with loader_lock:
+            # Another thread may have refreshed it while we waited
+            status = self.cached(base_url)
+            if status is not None:
+                return status
+            status = loader()
+            if status is not None:
+                self.store(base_url, status)
+        return status
+
+
 class APIDownloader(PageGetter):
-    def __init__(self, sub_id: int, api_url: Union[str, List[str]]):
+    network = True
+
+    def __init__(
+            self,
+            sub_id: int,
+            api_url: Union[str, List[str]],
+            session=requests,
+            status_cache: Optional[StatusCache] = None,
+            conditional: Optional[dict] = None
+    ):
         self.sub_id = sub_id
         self.api_url = api_url
+        self.session = session
+        self.status_cache = status_cache
+        self.conditional = conditional
         self.over_10k_registered = False
+        self.status_code = None
 
-    def make_url(self, path):
+    def base_url(self):
         api_url = self.api_url
         if isinstance(self.api_url, list):
             options = len(self.api_url)
             api_url = self.api_url[self.sub_id % options]
-        url = api_url + path
+        return api_url
+
+    def make_url(self, path):
+        url = self.base_url() + path
         return url
 
     def download_sub_data(self):
         path = f"/submission/{self.sub_id}.json"
         url = self.make_url(path)
-        return self.download_json(url)
+        data = self.download_json(url, self.conditional, keep_validators=True)
+        self.deleted = self.status_code == 404
+        return data
 
-    def download_json(self, url):
-        resp = requests.get(url, headers={"User-Agent": USER_AGENT})
+    def download_json(self, url, conditional: Optional[dict] = None, keep_validators: bool = False):
+        resp = self.session.get(url, headers={"User-Agent": USER_AGENT, **conditional_headers(conditional)})
+        self.bytes_received += len(resp.content)
+        self.status_code = resp.status_code
+        if resp.status_code == 304 and conditional is not None:
+            self.not_modified = True
+            return None
+        if resp.status_code in [429, 503]:
+            raise RateLimitedError(resp.status_code, f"API is rate limiting us. ({resp.status_code})")
+        if resp.status_code >= 500:
+            raise Exception(f"API server error. ({resp.status_code})")
         if resp.status_code != 200:
             return None
+        if keep_validators:
+            self.validators = response_validators(resp)
         data = resp.json()
         return data
 
     def download_status(self):
         path = f"/status.json"
         url = self.make_url(path)
-        return self.download_json(url)
+        if self.status_cache is None:
+            return self.download_json(url)
+        return self.status_cache.get(self.base_url(), lambda: self.download_json(url))
 
     def result(self) -> Optional[PageResult]:
-        print(f"Downloading: {self.sub_id}")
-        data = self.download_sub_data()
-
-        status = self.download_status()
+        with self.tracer.span("download_sub_data"):
+            data = self.download_sub_data()
+        with self.tracer.span("download_status"):
+            status = self.download_status()
+        self.read_status(status)
+        return self.parse_sub_data(data)
+
+    def read_status(self, status):
+        if status is None:
+            return
         if status['online']['registered'] > 10000:
             self.over_10k_registered = True
 
+    def parse_sub_data(self, data) -> Optional[PageResult]:
         if data is None:
             return None
         return PageResult(
@@ -226,154 +356,384 @@ class DataMerger(PageGetter):
 
 
 class ArchiveTeamReader(PageGetter):
-    def __init__(self, sub_id, file_name):
+    cpu_bound = True
+
+    def __init__(self, sub_id, file_name, parser_backend: str = "html.parser"):
         self.sub_id = sub_id
         self.file_name = file_name
+        self.parser_backend = parser_backend
 
-    def result(self) -> Optional[PageResult]:
+    def read_file(self) -> str:
         encodings = ["utf-8", "cp1252", "cp850"]
-        html = None
         for encoding in encodings:
             try:
                 with open(self.file_name, "r", encoding=encoding) as archive_file:
-                    html = archive_file.read()
-                    break
+                    return archive_file.read()
             except UnicodeDecodeError:
                 continue
-        if html is None:
-            raise Exception("Could not decode submission from archive team")
-        soup = BeautifulSoup(html, "html.parser")
-        main_table = soup.select_one('table.maintable table.maintable table.maintable')
-        if main_table is None:
+        raise Exception("Could not decode submission from archive team")
+
+    def result(self) -> Optional[PageResult]:
+        with self.tracer.span("read_file"):
+            html = self.read_file()
+        self.bytes_received += len(html)
+        start_time = time.perf_counter()
+        with self.tracer.span("parse_archive_page"):
+            fields = parse_archive_page(html, self.parser_backend)
+        self.parse_seconds += time.perf_counter() - start_time
+        if fields is None:
             return None
+        return PageResult(self.sub_id, **fields)
+
+
+class OldDataIndex:
+    def __init__(self, root="old_data", sidecar="old_data_index.json"):
+        self.root = root
+        self.sidecar = sidecar
+        self.starts = []
+        self.ends = []
+        self.max_ends = []
+        self.files = []
+
+    def directory_mtimes(self) -> dict:
+        mtimes = {}
+        for directory, _, _ in os.walk(self.root):
+            mtimes[directory] = os.stat(directory).st_mtime
+        return mtimes
+
+    def is_current(self, index_data: dict) -> bool:
+        # Adding or removing a file only changes the mtime of its own directory, so every directory is checked, and a
+        # new subdirectory shows up as a change to its parent
+        if not os.path.isdir(self.root):
+            return index_data["directories"] == {}
+        for directory, mtime in index_data["directories"].items():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+        return self.root in index_data["directories"]
+
+    def load(self):
+        try:
+            with open(self.sidecar, "r") as f:
+                index_data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index_data = None
+        # Sidecars from older versions only held the mtime of the root
+        if index_data is None or "directories" not in index_data or not self.is_current(index_data):
+            index_data = self.build()
+        self.set_ranges(index_data["ranges"])
+        return self
+
+    def build(self):
+        directories = self.directory_mtimes()
+        old_files = glob.glob(f"{self.root}/**/*.json", recursive=True)
+        ranges = [
+            [int(x.split(os.sep)[-1].split(".")[0].split("-")[y]) for y in [1, 2]] + [x]
+            for x in old_files
+        ]
+        ranges.sort()
+        index_data = {"directories": directories, "ranges": ranges}
+        with open(self.sidecar, "w") as f:
+            json.dump(index_data, f)
+        return index_data
+
+    def set_ranges(self, ranges):
+        self.starts = [x[0] for x in ranges]
+        self.ends = [x[1] for x in ranges]
+        self.files = [x[2] for x in ranges]
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def files_for_id(self, sub_id: int) -> List[str]:
+        # Ranges are sorted by start, max_ends lets us stop as soon as no earlier range can reach sub_id
+        position = bisect_right(self.starts, sub_id) - 1
+        files = []
+        while position >= 0 and self.max_ends[position] >= sub_id:
+            if self.ends[position] >= sub_id:
+                files.append(self.files[position])
+            position -= 1
+        return files
+
+
+class FileCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename):
+        while True:
+            with self.lock:
+                if filename in self.entries:
+                    self.entries.move_to_end(filename)
+                    self.hits += 1
+                    return self.entries[filename]["data"]
+                loaded = self.loading.get(filename)
+                if loaded is None:
+                    loaded = Event()
+                    self.loading[filename] = loaded
+                    self.misses += 1
+                    break
+            # Another thread is loading this file, wait for it then check again
+            loaded.wait()
+        try:
+            size = os.path.getsize(filename)
+            with open(filename, "r") as dump:
+                data = json.load(dump)
+            with self.lock:
+                self.entries[filename] = {"data": data, "size": size}
+                self.total_bytes += size
+                self.evict()
+        finally:
+            with self.lock:
+                del self.loading[filename]
+            loaded.set()
+        return data
 
-        title_bar = main_table.select_one('td.cat')
-        stats_container = main_table.select_one('td.alt1 td.alt1')
-        actions_bar = soup.select_one('div.actions')
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry["size"]
+            self.evictions += 1
 
-        username = title_bar.select_one('a')['href'].strip("/").split("/")[-1]
-        title = title_bar.select_one('b').text
-        description_raw = main_table.select('tr')[-1].select_one('td').decode_contents().strip()
-        description = "<br/>".join(description_raw.split("<br/>")[2:]).strip()
-        keywords = [x.text for x in stats_container.select('div#keywords a')]
-        date = parser.parse(stats_container.select_one('.popup_date').text).isoformat()
-        rating = stats_container.select_one('img')['alt'].replace(' rating', '')
-        filename = "https:" + [x['href'] for x in actions_bar.select('a') if x.text.strip() == "Download"][0]
+    def invalidate(self, filename):
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.total_bytes -= entry["size"]
 
-        return PageResult(
-            self.sub_id,
-            username,
-            title,
-            description,
-            keywords,
-            date,
-            rating,
-            filename
-        )
+    def stats(self):
+        return {
+            "files": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def run_getter_chunk(getters: List[PageGetter]) -> List[Tuple[Union[Optional[dict], Exception], dict]]:
+    results = []
+    for getter in getters:
+        start_time = time.monotonic()
+        start_ns = time.perf_counter_ns()
+        try:
+            result = getter.result()
+            result = None if result is None else result.to_dict()
+        except Exception as e:
+            result = e
+        # Metrics are kept in the parent process, so what the worker measured goes back with each result
+        timings = {
+            "seconds": time.monotonic() - start_time,
+            "bytes": getter.bytes_received,
+            "parse_seconds": getter.parse_seconds,
+            "start_ns": start_ns,
+            "duration_ns": time.perf_counter_ns() - start_ns,
+            "pid": os.getpid()
+        }
+        results.append((result, timings))
+    return results
 
 
 class Scraper:
     def __init__(self, config):
         self.batch_size = 100
         self.config = config
-        self.pool = ThreadPool(8)
-        self.slow_down = False
-        self.latest_file = {
-            "old_data": {
-                "filename": None,
-                "data": None,
-                "lock": RLock()
-            },
-            "batch_file": {
-                "filename": None,
-                "data": None,
-                "lock": RLock()
-            }
-        }
-        old_files = glob.glob("old_data/**/*.json", recursive=True)
-        self.old_file_ranges = [
-            [int(x.split(os.sep)[-1].split(".")[0].split("-")[y]) for y in [1, 2]] + [x]
-            for x in old_files
-        ]
+        self.workers = config.get("WORKERS", 8)
+        self.pool = ThreadPool(self.workers)
+        self.processes = config.get("PROCESSES", 0)
+        self.process_chunk = config.get("PROCESS_CHUNK", 10)
+        self.process_pool = ProcessPoolExecutor(self.processes) if self.processes else None
+        self.http = SessionPool(self.workers, config.get("HTTP_POOL_PER_HOST"))
+        self.status_cache = StatusCache(config.get("STATUS_TTL", 5))
+        self.controller = ConcurrencyController(
+            config.get("MAX_IN_FLIGHT", self.workers),
+            peak_limit=config.get("PEAK_IN_FLIGHT", 2),
+            target_latency=config.get("TARGET_LATENCY", 3.0)
+        )
+        self.retries = config.get("RETRIES", 5)
+        self.metrics = Metrics()
+        self.metrics.add_gauges(self.metric_gauges)
+        if "METRICS_PORT" in config:
+            self.metrics.serve(config["METRICS_PORT"])
+        self.summary_interval = config.get("SUMMARY_SECONDS", 30)
+        self.dead_letter_file = config.get("DEAD_LETTER_FILE", "dead_letter.jsonl")
+        self.dead_letters = []
+        self.dead_letter_lock = Lock()
+        self.file_cache = FileCache(config.get("FILE_CACHE_BYTES", 256 * 1024 * 1024))
+        self.old_data_index = OldDataIndex().load()
+        self.archive_index = ArchiveIndex().load()
+        self.parser_backend = resolve_backend(config.get("PARSER", "auto"))
+        self.site_url = config.get("FA_URL", "http://furaffinity.net")
+        self.uploader = None
+        if "UPLOAD" in config:
+            spool_dir = config.get("UPLOAD_SPOOL_DIR", "upload_spool/")
+            self.uploader = Uploader(self.http, config["UPLOAD"], USER_AGENT, spool_dir)
+        self.manifest = BatchManifest(config.get("BATCH_MANIFEST", "batch_manifest.bin"), self.batch_size)
+        self.gap_fill = config.get("GAP_FILL", False)
+        self.segment_store = None
+        if config.get("STORAGE", "json") == "segments":
+            self.segment_store = SegmentStore(config.get("SEGMENT_DIR", "segments/"), self.batch_size)
+        self.fetch_log = FetchLog(
+            config.get("FETCH_LOG", "fetch_log.bin"),
+            config.get("FETCH_VALIDATORS", "fetch_validators.jsonl")
+        )
+        self.refresh_max_age = config.get("REFRESH_MAX_AGE_DAYS", 30) * 86400
+        self.tracer = NULL_TRACER
+        if "TRACE_DIR" in config:
+            self.tracer = Tracer(config["TRACE_DIR"], config.get("TRACE_SAMPLE_INTERVAL"))
 
-    def get_file_data(self, file_key: str, filename_wanted):
-        file_entry = self.latest_file[file_key]
-        if file_entry["filename"] == filename_wanted:
-            return file_entry["data"]
-        with self.latest_file[file_key]["lock"]:
-            # Read new file
-            with open(filename_wanted, "r") as dump:
-                data = json.load(dump)
-            # Set variables
-            new_obj = {
-                "filename": filename_wanted,
-                "data": data,
-                "lock": self.latest_file[file_key]["lock"]
-            }
-            self.latest_file[file_key] = new_obj
-        return data
+    def get_file_data(self, filename_wanted):
+        with self.tracer.span("get_file_data"):
+            return self.file_cache.get(filename_wanted)
 
     def check_old_data(self, sub_id: int) -> Union[bool, dict]:
-        for file in self.old_file_ranges:
-            if file[0] <= sub_id <= file[1]:
-                old_data = self.get_file_data("old_data", file[2])
-                if str(sub_id) in old_data:
-                    return old_data[str(sub_id)]
+        with self.tracer.span("check_old_data"):
+            files = self.old_data_index.files_for_id(sub_id)
+        for file in files:
+            old_data = self.get_file_data(file)
+            if str(sub_id) in old_data:
+                return old_data[str(sub_id)]
         return False
 
     def already_exists(self, sub_id) -> Union[bool, Optional[dict]]:
+        if self.segment_store is not None:
+            data = self.segment_store.load_batch((sub_id // self.batch_size) * self.batch_size)
+            if data is not None and str(sub_id) in data:
+                return data[str(sub_id)]
+            return False
         directory, filename = self.filename_for_id(sub_id)
         if os.path.exists(directory + filename):
-            data = self.get_file_data("batch_file", directory + filename)
+            data = self.get_file_data(directory + filename)
             if str(sub_id) in data:
                 return data[str(sub_id)]
         return False
 
     def in_archive(self, sub_id) -> Union[bool, str]:
-        dir_name = f"fa-extract/www.furaffinity.net/view/{sub_id}/"
-        file_name = glob.glob(f"{dir_name}*")
-        if len(file_name) == 0:
-            return False
-        return file_name[0]
+        with self.tracer.span("in_archive"):
+            return self.archive_index.lookup(sub_id)
 
     def pick_downloader(self, sub_id):
-        # Check if already got the data
-        batch_data = self.already_exists(sub_id)
-        if batch_data is not False:
-            return DataMerger(sub_id, batch_data)
-        # Check if data is in old format
-        old_data = self.check_old_data(sub_id)
-        if old_data is not False:
-            return OldDataUpdater(sub_id, old_data)
-        # Check if data is in archive team data
-        archive_file = self.in_archive(sub_id)
-        if archive_file is not False:
-            return ArchiveTeamReader(sub_id, archive_file)
-        elif 'API_URL' in self.config:
-            return APIDownloader(sub_id, self.config['API_URL'])
+        with self.tracer.span("pick_downloader"):
+            # Check if already got the data
+            with self.tracer.span("already_exists"):
+                batch_data = self.already_exists(sub_id)
+            # When filling gaps, null entries are fetched again
+            if batch_data is not False and not (self.gap_fill and batch_data is None):
+                return DataMerger(sub_id, batch_data)
+            # Check if data is in old format
+            old_data = self.check_old_data(sub_id)
+            if old_data is not False:
+                return OldDataUpdater(sub_id, old_data)
+            # Check if data is in archive team data
+            archive_file = self.in_archive(sub_id)
+            if archive_file is not False:
+                return ArchiveTeamReader(sub_id, archive_file, self.parser_backend)
+            return self.network_downloader(sub_id)
+
+    def network_downloader(self, sub_id, conditional: Optional[dict] = None):
+        if 'API_URL' in self.config:
+            return APIDownloader(sub_id, self.config['API_URL'], self.http, self.status_cache, conditional)
         elif 'LOGIN_COOKIE' in self.config:
-            return WebsiteDownloader(sub_id, self.config['LOGIN_COOKIE'])
+            return WebsiteDownloader(
+                sub_id, self.config['LOGIN_COOKIE'], self.http, self.parser_backend, self.site_url, conditional
+            )
         else:
             raise Exception("Please set API_URL or LOGIN_COOKIE in config")
 
     def download_entry(self, sub_id):
-        if self.slow_down:
-            print("Waiting")
-            time.sleep(4)
-        downloader = self.pick_downloader(sub_id)
-        print(f"Picked: {downloader.__class__.__name__}")
-        while True:
-            try:
+        with self.tracer.span("download_entry"):
+            downloader = self.pick_downloader(sub_id)
+            return self.run_downloader(downloader)
+
+    def attempt_download(self, downloader):
+        getter = downloader.__class__.__name__
+        downloader.tracer = self.tracer
+        if not downloader.network:
+            start_time = time.monotonic()
+            with self.tracer.span(getter):
                 result = downloader.result()
+            self.metrics.observe("fa_indexer_request_seconds", time.monotonic() - start_time, getter=getter)
+            return result
+        wait_start = time.monotonic()
+        with self.tracer.span("throttle_wait"):
+            self.controller.acquire()
+        start_time = time.monotonic()
+        self.metrics.inc("fa_indexer_throttle_wait_seconds_total", start_time - wait_start, getter=getter)
+        status = None
+        try:
+            with self.tracer.span(getter):
+                return downloader.result()
+        except RateLimitedError as e:
+            status = e.status_code
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            latency = time.monotonic() - start_time
+            self.metrics.observe("fa_indexer_request_seconds", latency, getter=getter)
+            self.controller.release(latency, status, downloader.should_slow_down())
+
+    def record_result(self, downloader, result):
+        getter = downloader.__class__.__name__
+        if downloader.network:
+            outcome = OK if result is not None or downloader.not_modified else NULL
+            self.fetch_log.record(downloader.sub_id, outcome, validators=downloader.validators)
+        self.metrics.inc("fa_indexer_entries_total", getter=getter)
+        self.metrics.inc("fa_indexer_bytes_total", downloader.bytes_received, getter=getter)
+        if downloader.parse_seconds:
+            self.metrics.observe("fa_indexer_parse_seconds", downloader.parse_seconds, getter=getter)
+
+    def record_worker_result(self, downloader, result, timings: dict):
+        # The downloader here is the parent's copy, so it takes on what the worker's copy measured
+        getter = downloader.__class__.__name__
+        downloader.bytes_received = timings["bytes"]
+        downloader.parse_seconds = timings["parse_seconds"]
+        self.tracer.add(getter, timings["start_ns"], timings["duration_ns"], timings["pid"], {"id": downloader.sub_id})
+        self.metrics.observe("fa_indexer_request_seconds", timings["seconds"], getter=getter)
+        self.record_result(downloader, result)
+
+    def record_retry(self, downloader, error):
+        getter = downloader.__class__.__name__
+        self.metrics.inc("fa_indexer_retries_total", getter=getter)
+        print(f"Exception downloading submission {downloader.sub_id}: {error}")
+
+    def run_downloader(self, downloader):
+        for attempt in range(self.retries + 1):
+            try:
+                result = self.attempt_download(downloader)
                 break
             except Exception as e:
-                print(f"Exception downloading submission {sub_id}: {e}")
-                time.sleep(10)
-        slow_down = downloader.should_slow_down()
-        if slow_down is not None:
-            self.slow_down = slow_down
+                self.record_retry(downloader, e)
+                if attempt == self.retries:
+                    downloader.failed = True
+                    self.dead_letter(downloader.sub_id, e)
+                    return None
+                time.sleep(retry_delay(attempt))
+        self.record_result(downloader, result)
         return None if result is None else result.to_dict()
 
+    def dead_letter(self, sub_id, error):
+        entry = {"id": sub_id, "error": str(error), "time": datetime.datetime.now().isoformat()}
+        self.fetch_log.record(sub_id, ERROR)
+        with self.dead_letter_lock:
+            self.dead_letters.append(sub_id)
+            self.metrics.inc("fa_indexer_dead_letters_total")
+            with open(self.dead_letter_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        print(f"Giving up on submission {sub_id} after {self.retries + 1} attempts")
+
     def make_directories(self, directory):
         os.makedirs(os.path.dirname(directory), exist_ok=True)
 
@@ -385,39 +745,190 @@ class Scraper:
         return directory, filename
 
     def save_batch(self, start_id, full_data):
+        self.write_batch(start_id, full_data)
+        self.manifest.mark(start_id, full_data)
+
+    def write_batch(self, start_id, full_data):
         directory, filename = self.filename_for_id(start_id)
-        if "UPLOAD" in self.config:
-            self.upload_batch(directory + filename, full_data)
+        if self.uploader is not None:
+            self.uploader.spool(directory + filename, full_data)
+            return
+        if self.segment_store is not None:
+            self.segment_store.save_batch(start_id, full_data)
             return
         self.make_directories(directory)
         with open(directory + filename, "w+") as dump_file:
             json.dump(full_data, dump_file)
+        self.file_cache.invalidate(directory + filename)
 
-    def upload_batch(self, path, full_data):
-        url = self.config['UPLOAD']['URL'] + path
-        headers = {
-            "Authorization": self.config['UPLOAD']['KEY'],
-            "User-Agent": USER_AGENT
+    def scrape_batch(self, start, end):
+        with self.tracer.span("scrape_batch", {"start": start}):
+            full_data = dict()
+            id_range = list(range(start, end+1))
+            if self.process_pool is None:
+                results = self.pool.map(self.download_entry, id_range)
+            else:
+                results = self.scrape_batch_hybrid(id_range)
+            for result_key in range(len(results)):
+                full_data[str(start+result_key)] = results[result_key]
+            with self.tracer.span("save_batch"):
+                self.save_batch(start, full_data)
+        self.tracer.flush()
+
+    def scrape_batch_hybrid(self, id_range):
+        downloaders = self.pool.map(self.pick_downloader, id_range)
+        results = [None] * len(downloaders)
+        # Send CPU bound local sources to the process pool, in chunks, while network sources run in threads
+        cpu_keys = [key for key, downloader in enumerate(downloaders) if downloader.cpu_bound]
+        io_keys = [key for key, downloader in enumerate(downloaders) if not downloader.cpu_bound]
+        chunks = [cpu_keys[i:i + self.process_chunk] for i in range(0, len(cpu_keys), self.process_chunk)]
+        futures = [
+            self.process_pool.submit(run_getter_chunk, [downloaders[key] for key in chunk])
+            for chunk in chunks
+        ]
+        io_results = self.pool.map(self.run_downloader, [downloaders[key] for key in io_keys])
+        for key, result in zip(io_keys, io_results):
+            results[key] = result
+        for chunk, future in zip(chunks, futures):
+            for key, (result, timings) in zip(chunk, future.result()):
+                if isinstance(result, Exception):
+                    # Fall back to the usual retry loop in this process
+                    result = self.run_downloader(downloaders[key])
+                else:
+                    self.record_worker_result(downloaders[key], result, timings)
+                results[key] = result
+        return results
+
+    def metric_gauges(self):
+        http = self.http.stats()
+        cache = self.file_cache.stats()
+        return {
+            "fa_indexer_http_requests_total": http["requests"],
+            "fa_indexer_http_connections_total": http["connections"],
+            "fa_indexer_file_cache_hits_total": cache["hits"],
+            "fa_indexer_file_cache_misses_total": cache["misses"],
+            "fa_indexer_file_cache_evictions_total": cache["evictions"],
+            "fa_indexer_file_cache_bytes": cache["bytes"],
+            "fa_indexer_status_cache_hits_total": self.status_cache.hits,
+            "fa_indexer_status_cache_misses_total": self.status_cache.misses,
+            "fa_indexer_concurrency_limit": self.controller.limit,
+            "fa_indexer_in_flight": self.controller.in_flight,
+            "fa_indexer_peak": int(self.controller.peak)
         }
-        requests.post(url, json=full_data, headers=headers)
 
-    def scrape_batch(self, start, end):
-        full_data = dict()
-        id_range = list(range(start, end+1))
-        results = self.pool.map(self.download_entry, id_range)
-        for result_key in range(len(results)):
-            full_data[str(start+result_key)] = results[result_key]
-        self.save_batch(start, full_data)
+    def summary_extra(self):
+        cache = self.file_cache.stats()
+        lookups = cache["hits"] + cache["misses"]
+        hit_rate = 100 * cache["hits"] / lookups if lookups else 0
+        return f", concurrency limit {self.controller.limit:.1f}, file cache hit rate {hit_rate:.0f}%, " \
+               f"{len(self.dead_letters)} dead letters"
+
+    def start_summary(self, start, end):
+        self.metrics.set_block(start, end)
+        return self.metrics.start_summary(self.summary_interval, self.summary_extra)
+
+    def should_scrape_batch(self, batch_start):
+        if not self.manifest.is_complete(batch_start):
+            return True
+        return self.gap_fill and self.manifest.is_partial(batch_start)
 
     def scrape(self, start=1, end=None):
         batch_start = (start // self.batch_size) * self.batch_size
         batch_end = batch_start + self.batch_size - 1
+        stop_summary = self.start_summary(batch_start, end)
         while (end is None) or (batch_start < end):
+            if not self.should_scrape_batch(batch_start):
+                self.metrics.batch_done(self.batch_size, skipped=True)
+                batch_start = batch_end + 1
+                batch_end = batch_start + self.batch_size - 1
+                continue
             print(f"START BATCH: {batch_start} - {batch_end}")
             self.scrape_batch(batch_start, batch_end)
             print(f"END BATCH: {batch_start} - {batch_end}")
+            self.metrics.batch_done(self.batch_size)
             batch_start = batch_end + 1
             batch_end = batch_start + self.batch_size - 1
+        stop_summary.set()
+        self.tracer.flush()
+
+    def load_saved_batch(self, batch_start) -> Optional[dict]:
+        # Uploaded batches are never written locally, so they are read back from the spool or the server
+        if self.uploader is not None:
+            return self.uploader.load(self.batch_path(batch_start))
+        if self.segment_store is not None:
+            return self.segment_store.load_batch(batch_start)
+        directory, filename = self.filename_for_id(batch_start)
+        if not os.path.exists(directory + filename):
+            return None
+        return self.get_file_data(directory + filename)
+
+    def refresh_entry(self, sub_id, existing: Optional[dict]):
+        # Only ask for changes if there is saved data to fall back on
+        conditional = self.fetch_log.validators_for(sub_id) if existing is not None else None
+        downloader = self.network_downloader(sub_id, conditional)
+        result = self.run_downloader(downloader)
+        if downloader.not_modified or downloader.failed:
+            return existing
+        # An empty result only replaces saved data when the site says the submission no longer exists
+        if result is None and not downloader.deleted:
+            return existing
+        return result
+
+    def refresh(self, start=1, end=None):
+        # Newer submissions are the most likely to have changed, so refresh from the end of the range backwards
+        if end is None:
+            if self.uploader is not None:
+                raise ValueError("Refreshing uploaded batches needs an END ID, as there is no local data to find it")
+            end = find_latest_downloaded_id()
+        first_batch = (start // self.batch_size) * self.batch_size
+        batch_start = (end // self.batch_size) * self.batch_size
+        stop_summary = self.start_summary(first_batch, end)
+        refreshed = 0
+        while batch_start >= first_batch:
+            batch_end = batch_start + self.batch_size - 1
+            saved = self.load_saved_batch(batch_start)
+            stale_ids = [] if saved is None else [
+                sub_id for sub_id in self.fetch_log.stale_ids(batch_start, batch_end, self.refresh_max_age)
+                if start <= sub_id <= end and str(sub_id) in saved
+            ]
+            if stale_ids:
+                print(f"REFRESH BATCH: {batch_start} - {batch_end}, {len(stale_ids)} stale")
+                results = self.pool.map(lambda sub_id: self.refresh_entry(sub_id, saved[str(sub_id)]), stale_ids)
+                full_data = dict(saved)
+                for sub_id, result in zip(stale_ids, results):
+                    full_data[str(sub_id)] = result
+                self.save_batch(batch_start, full_data)
+                refreshed += len(stale_ids)
+            self.metrics.batch_done(self.batch_size, skipped=not stale_ids)
+            batch_start -= self.batch_size
+        stop_summary.set()
+        self.tracer.flush()
+        print(f"Refreshed {refreshed} submissions")
+
+    def batch_path(self, batch_start: int) -> str:
+        directory, filename = self.filename_for_id(batch_start)
+        return directory + filename
+
+    def batch_delivered(self, batch_start: int) -> bool:
+        # With uploads, a batch only counts once the server has saved it, not when it is spooled locally
+        if not self.manifest.is_complete(batch_start):
+            return False
+        return self.uploader is None or self.uploader.is_delivered(self.batch_path(batch_start))
+
+    def scrape_lease_run(self, start: int, end: int):
+        self.scrape(start, end)
+        if self.uploader is not None:
+            # Heartbeats keep the lease alive while its batches finish uploading
+            self.uploader.wait_for([self.batch_path(x) for x in range(start, end + 1, self.batch_size)])
+
+    def scrape_leases(self, client: LeaseClient):
+        while True:
+            lease = client.acquire()
+            if lease is None:
+                print("Coordinator has no more batches to lease")
+                return
+            print(f"LEASE: {len(lease['batches'])} batches from {min(lease['batches'])}")
+            client.run_lease(lease, self.scrape_lease_run, self.batch_delivered)
 
 
 def find_latest_downloaded_id():
@@ -445,8 +956,21 @@ if __name__ == "__main__":
         with open("config.json", "w") as f:
             json.dump(conf, f, indent=2)
     # Create scraper, scrape block
-    scraper = Scraper(conf)
-    scraper.scrape(conf['START'], conf['END'])
+    if "ASYNC" in conf:
+        from async_scraper import AsyncScraper
+        scraper = AsyncScraper(conf)
+    else:
+        scraper = Scraper(conf)
+    if "COORDINATOR" in conf:
+        scraper.scrape_leases(LeaseClient(scraper.http, conf["COORDINATOR"], USER_AGENT))
+    elif conf.get("REFRESH", False):
+        scraper.refresh(conf['START'], conf['END'])
+    else:
+        scraper.scrape(conf['START'], conf['END'])
+    if scraper.uploader is not None:
+        scraper.uploader.wait_until_empty()
+    # Lease mode runs scrape once per lease, so the sampler is only stopped once everything has finished
+    scraper.tracer.close()
     # Set end time, calculate duration, and write
     if "END_TIME" not in conf:
         end_time = datetime.datetime.now()
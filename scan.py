@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Tuple
+
+from segment_store import SegmentStore
+
+RECORD_FIELDS = ["username", "title", "description", "keywords", "date", "rating", "filename"]
+
+
+def overlaps(range_start: int, range_end: int, start: Optional[int], end: Optional[int]) -> bool:
+    if start is not None and range_end <= start:
+        return False
+    if end is not None and range_start > end:
+        return False
+    return True
+
+
+def numbered_entries(directory: str) -> List[str]:
+    try:
+        return sorted((x for x in os.listdir(directory) if x.isdigit()), key=int)
+    except FileNotFoundError:
+        return []
+
+
+def batch_files(data_dir="data/", start: int = None, end: int = None) -> Iterator[str]:
+    # Directories are data/<millions>/<ten thousands>/, so whole directories outside the range can be skipped
+    for dir_1 in numbered_entries(data_dir):
+        dir_1_start = int(dir_1) * 1000000
+        if not overlaps(dir_1_start, dir_1_start + 1000000, start, end):
+            continue
+        for dir_2 in numbered_entries(os.path.join(data_dir, dir_1)):
+            dir_2_start = dir_1_start + int(dir_2) * 10000
+            if not overlaps(dir_2_start, dir_2_start + 10000, start, end):
+                continue
+            directory = os.path.join(data_dir, dir_1, dir_2)
+            files = [x for x in os.listdir(directory) if x.startswith("batch-") and x.endswith(".json")]
+            for filename in sorted(files):
+                batch_start, batch_end = [int(x) for x in filename[:-len(".json")].split("-")[1:3]]
+                if overlaps(batch_start, batch_end, start, end):
+                    yield os.path.join(directory, filename)
+
+
+def intern_entry(entry: dict) -> dict:
+    # Usernames, ratings and keywords repeat across the corpus, so records share one copy of each
+    for field in ["username", "rating"]:
+        if isinstance(entry.get(field), str):
+            entry[field] = sys.intern(entry[field])
+    if isinstance(entry.get("keywords"), list):
+        entry["keywords"] = [sys.intern(x) if isinstance(x, str) else x for x in entry["keywords"]]
+    return entry
+
+
+def project(entries: dict, fields: Optional[List[str]], start: Optional[int], end: Optional[int]) -> List[dict]:
+    records = []
+    for key, entry in entries.items():
+        if entry is None:
+            continue
+        sub_id = int(key)
+        if (start is not None and sub_id < start) or (end is not None and sub_id > end):
+            continue
+        if fields is not None:
+            entry = {field: entry[field] for field in fields}
+            entry["id"] = sub_id
+        records.append(intern_entry(entry))
+    return records
+
+
+def load_batch_file(args: Tuple[str, Optional[List[str]], Optional[int], Optional[int]]) -> List[dict]:
+    filename, fields, start, end = args
+    with open(filename, "r") as f:
+        entries = json.load(f)
+    return project(entries, fields, start, end)
+
+
+def to_page_result(entry: dict):
+    # Imported here so the server can list batch files without the scraper's dependencies
+    from run import PageResult
+    return PageResult(entry["id"], *[entry.get(field) for field in RECORD_FIELDS])
+
+
+def scan_records(
+        data_dir="data/",
+        fields: List[str] = None,
+        start: int = None,
+        end: int = None,
+        processes: int = None,
+        segment_dir: str = None
+) -> Iterator[dict]:
+    if segment_dir is not None:
+        store = SegmentStore(segment_dir)
+        for _, entries in store.iter_batches(start, end):
+            yield from project(entries, fields, start, end)
+        return
+    jobs = ((filename, fields, start, end) for filename in batch_files(data_dir, start, end))
+    if processes == 1:
+        for job in jobs:
+            yield from load_batch_file(job)
+        return
+    with Pool(processes) as pool:
+        for records in pool.imap(load_batch_file, jobs, chunksize=16):
+            yield from records
+
+
+def scan(
+        data_dir="data/",
+        fields: List[str] = None,
+        start: int = None,
+        end: int = None,
+        processes: int = None,
+        segment_dir: str = None
+) -> Iterator:
+    for record in scan_records(data_dir, fields, start, end, processes, segment_dir):
+        yield to_page_result(record)
@@ -0,0 +1,532 @@
+import datetime
+import heapq
+import json
+import os
+import re
+import shutil
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+import dateutil.parser as parser
+
+from atomic_file import write_atomic
+
+INDEX_DIR = "index/search/"
+DATE_BLOCK = 256
+INDEX_FIELDS = ["username", "title", "keywords", "rating", "date"]
+WORD = re.compile(r"\w+", re.UNICODE)
+FIELD_PREFIXES = {
+    "keyword": "keyword",
+    "keywords": "keyword",
+    "title": "title",
+    "user": "user",
+    "username": "user",
+    "rating": "rating"
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [x.lower() for x in WORD.findall(text or "")]
+
+
+def terms_for_record(record: dict) -> set:
+    terms = set()
+    for keyword in record.get("keywords") or []:
+        terms.add(f"keyword:{keyword.lower()}")
+    for word in tokenize(record.get("title")):
+        terms.add(f"title:{word}")
+    if record.get("username"):
+        terms.add(f"user:{record['username'].lower()}")
+    if record.get("rating"):
+        terms.add(f"rating:{record['rating'].lower()}")
+    return terms
+
+
+def parse_timestamp(date: Optional[str]) -> int:
+    if not date:
+        return -1
+    try:
+        return int(parser.parse(date).timestamp())
+    except (ValueError, OverflowError):
+        return -1
+
+
+def encode_postings(sub_ids: Iterable[int]) -> bytes:
+    # Sorted IDs are stored as varint encoded gaps
+    output = bytearray()
+    previous = 0
+    for sub_id in sub_ids:
+        gap = sub_id - previous
+        previous = sub_id
+        while gap >= 0x80:
+            output.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        output.append(gap)
+    return bytes(output)
+
+
+def decode_postings(data: bytes) -> array:
+    sub_ids = array("q")
+    previous = 0
+    gap = 0
+    shift = 0
+    for byte in data:
+        gap |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += gap
+        sub_ids.append(previous)
+        gap = 0
+        shift = 0
+    return sub_ids
+
+
+def block_bounds(times: array, block_size: int = DATE_BLOCK):
+    # IDs are nearly in date order, so the running maximum up to each block and the minimum from each block onwards
+    # are both sorted, and bound where a date range can start and end
+    maxes = array("q")
+    running_max = None
+    for block_start in range(0, len(times), block_size):
+        block_max = max(times[block_start:block_start + block_size])
+        running_max = block_max if running_max is None else max(running_max, block_max)
+        maxes.append(running_max)
+    mins = array("q")
+    running_min = None
+    for block_start in reversed(range(0, len(times), block_size)):
+        block_min = min(times[block_start:block_start + block_size])
+        running_min = block_min if running_min is None else min(running_min, block_min)
+        mins.append(running_min)
+    mins.reverse()
+    return maxes, mins
+
+
+def gallop_down(values, target: int, high: int) -> int:
+    # Finds where target would go in values[:high], searching back from high, so walking IDs in descending order
+    # costs time in proportion to the distance skipped rather than the length of the list
+    step = 1
+    low = high - step
+    while low > 0 and values[low] > target:
+        high = low
+        step *= 2
+        low = high - step
+    return bisect_left(values, target, max(0, low), high)
+
+
+def merge_unique(lists: List[array]) -> array:
+    lists = [x for x in lists if len(x)]
+    if len(lists) == 1:
+        return lists[0]
+    merged = array("q")
+    for sub_id in heapq.merge(*lists):
+        if not merged or merged[-1] != sub_id:
+            merged.append(sub_id)
+    return merged
+
+
+def merge_ranges(ranges: Iterable[List[int]]) -> List[List[int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def without_ranges(sub_ids: array, ranges: List[List[int]]) -> array:
+    # Ranges are merged and sorted, so each one can be cut out of the sorted IDs with a bisect
+    if not ranges:
+        return sub_ids
+    kept = array("q")
+    position = 0
+    for start, end in ranges:
+        low = bisect_left(sub_ids, start, position)
+        high = bisect_right(sub_ids, end, low)
+        kept.extend(sub_ids[position:low])
+        position = max(position, high)
+    kept.extend(sub_ids[position:])
+    return kept
+
+
+def index_records(records: Iterable[dict]):
+    postings = {}
+    doc_ids = []
+    doc_dates = []
+    for record in records:
+        sub_id = record["id"]
+        doc_ids.append(sub_id)
+        doc_dates.append(parse_timestamp(record.get("date")))
+        for term in terms_for_record(record):
+            if term not in postings:
+                postings[term] = array("q")
+            postings[term].append(sub_id)
+        if len(doc_ids) % 1000000 == 0:
+            print(f"Indexed {len(doc_ids)} submissions, {len(postings)} terms")
+    return postings, doc_ids, doc_dates
+
+
+def read_manifest(index_dir: str) -> dict:
+    try:
+        with open(os.path.join(index_dir, "manifest.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        # Indexes built before delta segments only have a base directory
+        if os.path.exists(os.path.join(index_dir, "base", "terms.json")):
+            return {"segments": ["base"], "next_segment": 1}
+        return {"segments": [], "next_segment": 1}
+
+
+def write_manifest(index_dir: str, manifest: dict):
+    write_atomic(os.path.join(index_dir, "manifest.json"), json.dumps(manifest).encode())
+
+
+def write_segment(
+        directory: str,
+        postings: Dict[str, List[int]],
+        doc_ids: List[int],
+        doc_dates: List[int],
+        covered: List[List[int]] = None
+):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "covered.json"), "w") as f:
+        json.dump(merge_ranges(covered or []), f)
+    terms = {}
+    with open(os.path.join(directory, "postings.bin"), "wb") as f:
+        for term in sorted(postings):
+            data = encode_postings(postings[term])
+            terms[term] = [f.tell(), len(data), len(postings[term])]
+            f.write(data)
+    with open(os.path.join(directory, "terms.json"), "w") as f:
+        json.dump(terms, f)
+    with open(os.path.join(directory, "docs.ids"), "wb") as f:
+        f.write(array("q", doc_ids).tobytes())
+    with open(os.path.join(directory, "docs.dates"), "wb") as f:
+        f.write(array("q", doc_dates).tobytes())
+
+
+class IndexSegment:
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "terms.json"), "r") as f:
+            self.terms = json.load(f)
+        self.doc_ids = self.read_array("docs.ids")
+        self.doc_dates = self.read_array("docs.dates")
+        try:
+            with open(os.path.join(directory, "covered.json"), "r") as f:
+                self.covered = json.load(f)
+        except FileNotFoundError:
+            self.covered = []
+        self.covered_starts = [x[0] for x in self.covered]
+        self.postings_file = open(os.path.join(directory, "postings.bin"), "rb")
+        self.lock = Lock()
+        self.date_bounds = None
+
+    def read_array(self, filename) -> array:
+        values = array("q")
+        with open(os.path.join(self.directory, filename), "rb") as f:
+            values.frombytes(f.read())
+        return values
+
+    def postings(self, term: str) -> array:
+        entry = self.terms.get(term)
+        if entry is None:
+            return array("q")
+        with self.lock:
+            self.postings_file.seek(entry[0])
+            data = self.postings_file.read(entry[1])
+        return decode_postings(data)
+
+    def date_for(self, sub_id: int) -> Optional[int]:
+        position = bisect_left(self.doc_ids, sub_id)
+        if position == len(self.doc_ids) or self.doc_ids[position] != sub_id:
+            return None
+        return self.doc_dates[position]
+
+    def id_range(self, start: Optional[int], end: Optional[int]) -> Optional[List[int]]:
+        # IDs are nearly in date order, so the running date maximum and minimum of each block of IDs bound which IDs
+        # can fall inside a date range
+        if self.date_bounds is None:
+            self.date_bounds = block_bounds(self.doc_dates)
+        block_maxes, block_mins = self.date_bounds
+        low = 0
+        high = len(self.doc_ids)
+        if start is not None:
+            low = bisect_left(block_maxes, start) * DATE_BLOCK
+        if end is not None:
+            high = min(high, bisect_right(block_mins, end) * DATE_BLOCK)
+        if low >= high:
+            return None
+        return [self.doc_ids[low], self.doc_ids[high - 1]]
+
+    def covers(self, sub_id: int) -> bool:
+        position = bisect_right(self.covered_starts, sub_id) - 1
+        return position >= 0 and self.covered[position][1] >= sub_id
+
+    def all_ids(self) -> array:
+        return self.doc_ids
+
+    def close(self):
+        self.postings_file.close()
+
+
+def build_index(data_dir="data/", index_dir=INDEX_DIR, processes: int = None, segment_dir: str = None):
+    from scan import scan_records
+    records = scan_records(data_dir, INDEX_FIELDS, processes=processes, segment_dir=segment_dir)
+    postings, doc_ids, doc_dates = index_records(records)
+    manifest = read_manifest(index_dir)
+    name = f"base-{manifest['next_segment']}"
+    write_segment(os.path.join(index_dir, name), postings, doc_ids, doc_dates)
+    # A fresh full build replaces every existing segment
+    write_manifest(index_dir, {"segments": [name], "next_segment": manifest["next_segment"] + 1})
+    remove_segments(index_dir, manifest["segments"])
+    print(f"Indexed {len(doc_ids)} submissions, {len(postings)} terms")
+
+
+def segment_shadows(segments: List[IndexSegment]) -> List[List[List[int]]]:
+    # For each segment, the ID ranges which newer segments have replaced
+    shadows = []
+    covered = []
+    for segment in reversed(segments):
+        shadows.append(merge_ranges(covered))
+        covered.extend(segment.covered)
+    return list(reversed(shadows))
+
+
+def merge_segments(segments: List[IndexSegment]):
+    shadows = segment_shadows(segments)
+    docs = {}
+    for segment, shadow in zip(segments, shadows):
+        doc_ids = without_ranges(segment.doc_ids, shadow)
+        for sub_id in doc_ids:
+            docs[sub_id] = segment.date_for(sub_id)
+    terms = set()
+    for segment in segments:
+        terms.update(segment.terms.keys())
+    postings = {}
+    for term in terms:
+        term_ids = set()
+        for segment, shadow in zip(segments, shadows):
+            term_ids.update(without_ranges(segment.postings(term), shadow))
+        if term_ids:
+            postings[term] = sorted(term_ids)
+    doc_ids = sorted(docs)
+    doc_dates = [docs[x] for x in doc_ids]
+    covered = [x for segment in segments for x in segment.covered]
+    return postings, doc_ids, doc_dates, covered
+
+
+class Query:
+    def __init__(self, groups: List[List[str]], excluded: List[str]):
+        self.groups = groups
+        self.excluded = excluded
+
+    @staticmethod
+    def expand(word: str) -> List[str]:
+        if ":" in word:
+            prefix, value = word.split(":", 1)
+            field = FIELD_PREFIXES.get(prefix.lower())
+            if field is not None:
+                if field == "title":
+                    return [f"title:{x}" for x in tokenize(value)]
+                return [f"{field}:{value.lower()}"]
+        # Bare words match a keyword or a word in the title
+        return [f"keyword:{word.lower()}"] + [f"title:{x}" for x in tokenize(word)]
+
+    @classmethod
+    def parse(cls, query: str) -> "Query":
+        groups = []
+        excluded = []
+        join_next = False
+        negate_next = False
+        for word in query.split():
+            if word == "OR":
+                join_next = True
+                continue
+            if word == "NOT":
+                negate_next = True
+                continue
+            if word.startswith("-") and len(word) > 1:
+                word = word[1:]
+                negate_next = True
+            terms = cls.expand(word)
+            if negate_next:
+                excluded.extend(terms)
+            elif join_next and groups:
+                groups[-1].extend(terms)
+            else:
+                groups.append(terms)
+            join_next = False
+            negate_next = False
+        # Matching everything except some terms would mean walking every indexed ID
+        if excluded and not groups:
+            raise ValueError("Queries must include at least one term which is not excluded")
+        return cls(groups, excluded)
+
+
+class SearchIndex:
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        self.segments = []
+        self.shadows = []
+        self.segment_names = []
+        self.manifest_mtime = None
+        self.load()
+
+    def manifest_changed(self) -> bool:
+        try:
+            mtime = os.stat(os.path.join(self.index_dir, "manifest.json")).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        return mtime != self.manifest_mtime
+
+    def reload_if_changed(self):
+        # Other processes, such as a standalone index updater, may have added segments
+        if self.manifest_changed():
+            self.load()
+
+    def load(self):
+        try:
+            self.manifest_mtime = os.stat(os.path.join(self.index_dir, "manifest.json")).st_mtime
+        except FileNotFoundError:
+            self.manifest_mtime = None
+        manifest = read_manifest(self.index_dir)
+        existing = dict(zip(self.segment_names, self.segments))
+        segments = [
+            existing.get(name) or IndexSegment(os.path.join(self.index_dir, name))
+            for name in manifest["segments"]
+        ]
+        # Swap everything in at once, so running queries keep a consistent view
+        self.segments, self.shadows, self.segment_names = segments, segment_shadows(segments), manifest["segments"]
+
+    def postings(self, term: str, id_range: Optional[List[int]] = None) -> array:
+        results = []
+        for segment, shadow in zip(self.segments, self.shadows):
+            sub_ids = segment.postings(term)
+            if id_range is not None:
+                sub_ids = sub_ids[bisect_left(sub_ids, id_range[0]):bisect_right(sub_ids, id_range[1])]
+            results.append(without_ranges(sub_ids, shadow))
+        return merge_unique(results)
+
+    def union(self, terms: List[str], id_range: Optional[List[int]] = None) -> array:
+        return merge_unique([self.postings(term, id_range) for term in terms])
+
+    def date_for(self, sub_id: int) -> Optional[int]:
+        for segment in reversed(self.segments):
+            date = segment.date_for(sub_id)
+            if date is not None:
+                return date
+            if segment.covers(sub_id):
+                return None
+        return None
+
+    def date_id_range(self, start: Optional[int], end: Optional[int]) -> Optional[List[int]]:
+        ranges = [x for x in (segment.id_range(start, end) for segment in self.segments) if x is not None]
+        if not ranges:
+            return None
+        return [min(x[0] for x in ranges), max(x[1] for x in ranges)]
+
+    def search(self, query: Query, id_range: Optional[List[int]] = None):
+        # Yields matching IDs newest first, so a page can be served without finding every match
+        if not query.groups:
+            return
+        groups = sorted((self.union(group, id_range) for group in query.groups), key=len)
+        if not len(groups[0]):
+            return
+        excluded = self.union(query.excluded, id_range) if query.excluded else array("q")
+        others = groups[1:] + [excluded]
+        highs = [len(x) for x in others]
+        for sub_id in reversed(groups[0]):
+            matched = True
+            for position, values in enumerate(others):
+                high = gallop_down(values, sub_id, highs[position])
+                highs[position] = high
+                found = high < len(values) and values[high] == sub_id
+                if found != (values is not excluded):
+                    matched = False
+                    break
+            if matched:
+                yield sub_id
+
+    def query(
+            self,
+            query: str,
+            date_from: Optional[datetime.datetime] = None,
+            date_to: Optional[datetime.datetime] = None,
+            page: int = 1,
+            per_page: int = 50
+    ) -> dict:
+        start = int(date_from.timestamp()) if date_from is not None else None
+        end = int(date_to.timestamp()) if date_to is not None else None
+        parsed = Query.parse(query)
+        id_range = None
+        dated = start is not None or end is not None
+        if dated:
+            id_range = self.date_id_range(start, end)
+        offset = (page - 1) * per_page
+        ids = []
+        count = 0
+        more = False
+        if id_range is not None or not dated:
+            for sub_id in self.search(parsed, id_range):
+                if dated:
+                    date = self.date_for(sub_id)
+                    if date is None or date == -1:
+                        continue
+                    if (start is not None and date < start) or (end is not None and date > end):
+                        continue
+                if count == offset + per_page:
+                    more = True
+                    break
+                if count >= offset:
+                    ids.append(sub_id)
+                count += 1
+        return {
+            # Counting every match would mean walking the whole result, so the total is only known on the last page
+            "total": None if more else count,
+            "more": more,
+            "page": page,
+            "per_page": per_page,
+            "ids": ids
+        }
+
+
+def remove_segments(index_dir: str, names: List[str]):
+    for name in names:
+        shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def compact(index_dir=INDEX_DIR, include_base=False) -> List[str]:
+    manifest = read_manifest(index_dir)
+    names = manifest["segments"]
+    if not include_base:
+        names = [x for x in names if x.startswith("delta-")]
+    if len(names) < 2 and not include_base:
+        return []
+    segments = [IndexSegment(os.path.join(index_dir, x)) for x in names]
+    postings, doc_ids, doc_dates, covered = merge_segments(segments)
+    for segment in segments:
+        segment.close()
+    # The merged segment takes the position of the oldest segment it replaces
+    prefix = "base" if include_base else "delta"
+    merged_name = f"{prefix}-{manifest['next_segment']}"
+    write_segment(os.path.join(index_dir, merged_name), postings, doc_ids, doc_dates, covered)
+    manifest = read_manifest(index_dir)
+    position = manifest["segments"].index(names[0])
+    remaining = [x for x in manifest["segments"] if x not in names]
+    remaining.insert(position, merged_name)
+    write_manifest(index_dir, {"segments": remaining, "next_segment": manifest["next_segment"] + 1})
+    return names
+
+
+if __name__ == "__main__":
+    # Usage: python search_index.py [data dir] [index dir]
+    # or: python search_index.py compact [index dir]
+    if len(sys.argv) > 1 and sys.argv[1] == "compact":
+        index_dir = sys.argv[2] if len(sys.argv) > 2 else INDEX_DIR
+        remove_segments(index_dir, compact(index_dir, include_base=True))
+    else:
+        build_index(*sys.argv[1:3])
@@ -0,0 +1,250 @@
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional
+
+from atomic_file import write_atomic
+from search_index import DATE_BLOCK, block_bounds, parse_timestamp
+
+INDEX_DIR = "index/secondary/"
+# Every file holds little endian int64 values, so they can also be opened with numpy.memmap(..., dtype="<i8")
+ARRAY_FILES = ["name_offsets", "id_offsets", "user_ids", "date_ids", "date_times", "block_maxes", "block_mins"]
+
+
+class NameList:
+    # Lets bisect search the packed, sorted usernames without decoding them all
+    def __init__(self, index: "SecondaryIndex"):
+        self.index = index
+
+    def __len__(self):
+        return self.index.user_count
+
+    def __getitem__(self, position: int) -> str:
+        return self.index.username_at(position)
+
+
+def build_secondary_index(records: Iterable[dict], index_dir=INDEX_DIR):
+    user_ids = {}
+    date_ids = array("q")
+    date_times = array("q")
+    count = 0
+    for record in records:
+        sub_id = record["id"]
+        username = record.get("username")
+        if username:
+            if username not in user_ids:
+                user_ids[username] = array("q")
+            user_ids[username].append(sub_id)
+        timestamp = parse_timestamp(record.get("date"))
+        if timestamp != -1:
+            date_ids.append(sub_id)
+            date_times.append(timestamp)
+        count += 1
+        if count % 1000000 == 0:
+            print(f"Indexed {count} submissions, {len(user_ids)} users")
+    os.makedirs(index_dir, exist_ok=True)
+    names = bytearray()
+    name_offsets = array("q", [0])
+    id_offsets = array("q", [0])
+    all_user_ids = array("q")
+    for username in sorted(user_ids):
+        names += username.encode("utf-8")
+        name_offsets.append(len(names))
+        all_user_ids.extend(sorted(set(user_ids[username])))
+        id_offsets.append(len(all_user_ids))
+    order = sorted(range(len(date_ids)), key=lambda x: date_ids[x])
+    date_ids = array("q", [date_ids[x] for x in order])
+    date_times = array("q", [date_times[x] for x in order])
+    block_maxes, block_mins = block_bounds(date_times)
+    arrays = {
+        "name_offsets": name_offsets,
+        "id_offsets": id_offsets,
+        "user_ids": all_user_ids,
+        "date_ids": date_ids,
+        "date_times": date_times,
+        "block_maxes": block_maxes,
+        "block_mins": block_mins
+    }
+    write_atomic(os.path.join(index_dir, "names.bin"), bytes(names))
+    for name in ARRAY_FILES:
+        write_atomic(os.path.join(index_dir, f"{name}.bin"), arrays[name].tobytes())
+    # Written last, so readers only pick up a rebuild once every file is in place
+    meta = {"users": len(user_ids), "dated": len(date_ids), "block_size": DATE_BLOCK, "submissions": count}
+    write_atomic(os.path.join(index_dir, "meta.json"), json.dumps(meta).encode())
+    print(f"Indexed {count} submissions, {len(user_ids)} users")
+
+
+class SecondaryIndex:
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        self.meta_mtime = None
+        self.user_count = 0
+        self.date_count = 0
+        self.block_size = DATE_BLOCK
+        self.arrays = {}
+        self.names = b""
+        self.maps = []
+        self.load()
+
+    def meta_file(self) -> str:
+        return os.path.join(self.index_dir, "meta.json")
+
+    def current_mtime(self):
+        try:
+            return os.stat(self.meta_file()).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def reload_if_changed(self):
+        if self.current_mtime() != self.meta_mtime:
+            self.load()
+
+    def map_file(self, filename):
+        with open(os.path.join(self.index_dir, filename), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return mapped
+
+    def load(self):
+        self.meta_mtime = self.current_mtime()
+        try:
+            with open(self.meta_file(), "r") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {"users": 0, "dated": 0, "block_size": DATE_BLOCK}
+        arrays = {}
+        names = b""
+        # Maps from the previous load stay open while lookups still hold views of them
+        self.maps = []
+        if self.meta_mtime is not None:
+            names = self.map_file("names.bin")
+            for name in ARRAY_FILES:
+                arrays[name] = memoryview(self.map_file(f"{name}.bin")).cast("q")
+        # Swap everything in at once, so running lookups keep a consistent view
+        self.names, self.arrays = names, arrays
+        self.user_count, self.date_count, self.block_size = meta["users"], meta["dated"], meta["block_size"]
+
+    def username_at(self, position: int) -> str:
+        offsets = self.arrays["name_offsets"]
+        return bytes(self.names[offsets[position]:offsets[position + 1]]).decode("utf-8")
+
+    def list_users(self, prefix: str = "", page: int = 1, per_page: int = 500) -> dict:
+        names = NameList(self)
+        start = bisect_left(names, prefix)
+        if prefix:
+            # Nothing sorts between the prefix and the prefix followed by the highest code point, except its matches
+            end = bisect_left(names, prefix + "\U0010ffff", start)
+        else:
+            end = self.user_count
+        offset = start + (page - 1) * per_page
+        return {
+            "total": end - start,
+            "page": page,
+            "per_page": per_page,
+            "users": [names[x] for x in range(offset, min(end, offset + per_page))]
+        }
+
+    def user_range(self, username: str) -> List[int]:
+        names = NameList(self)
+        position = bisect_left(names, username)
+        if position == self.user_count or names[position] != username:
+            return [0, 0]
+        offsets = self.arrays["id_offsets"]
+        return [offsets[position], offsets[position + 1]]
+
+    def user_ids(self, username: str) -> List[int]:
+        low, high = self.user_range(username)
+        if low == high:
+            return []
+        return self.arrays["user_ids"][low:high].tolist()
+
+    def date_positions(self, start: Optional[int] = None, end: Optional[int] = None):
+        # Splits the dated IDs which can match into a sorted head and tail, which are checked one by one, and an inner
+        # run of positions which all match
+        if self.date_count == 0:
+            return [], 0, 0, []
+        times = self.arrays["date_times"]
+        block_maxes = self.arrays["block_maxes"]
+        block_mins = self.arrays["block_mins"]
+        low = 0
+        high = self.date_count
+        inner_low = 0
+        inner_high = self.date_count
+        # Blocks whose running maximum is before the start, or whose running minimum is after the end, can be skipped,
+        # while from a block whose running minimum is at or after the start every date is, and likewise for the end
+        if start is not None:
+            low = bisect_left(block_maxes, start) * self.block_size
+            inner_low = bisect_left(block_mins, start) * self.block_size
+        if end is not None:
+            high = min(self.date_count, bisect_right(block_mins, end) * self.block_size)
+            inner_high = min(self.date_count, bisect_right(block_maxes, end) * self.block_size)
+        inner_low = max(low, inner_low)
+        inner_high = min(high, inner_high)
+        if inner_low >= inner_high:
+            inner_low = inner_high = high
+
+        def matches(x):
+            return (start is None or times[x] >= start) and (end is None or times[x] <= end)
+        head = [x for x in range(low, inner_low) if matches(x)]
+        tail = [x for x in range(inner_high, high) if matches(x)]
+        return head, inner_low, inner_high, tail
+
+    def date_range_ids(self, start: Optional[int] = None, end: Optional[int] = None) -> List[int]:
+        if self.date_count == 0:
+            return []
+        head, inner_low, inner_high, tail = self.date_positions(start, end)
+        ids = self.arrays["date_ids"]
+        return [ids[x] for x in head] + ids[inner_low:inner_high].tolist() + [ids[x] for x in tail]
+
+    def user_query(self, username: str, page: int = 1, per_page: int = 50) -> dict:
+        low, high = self.user_range(username)
+        # Newest first, so a page is counted back from the end of the user's IDs
+        page_low, page_high = page_bounds(high - low, page, per_page)
+        ids = self.arrays["user_ids"][low + page_low:low + page_high].tolist() if page_low < page_high else []
+        return page_result(high - low, page, per_page, ids[::-1])
+
+    def date_query(self, start: Optional[int] = None, end: Optional[int] = None, page: int = 1, per_page: int = 50):
+        head, inner_low, inner_high, tail = self.date_positions(start, end)
+        total = len(head) + inner_high - inner_low + len(tail)
+        page_low, page_high = page_bounds(total, page, per_page)
+        positions = []
+        for x in range(page_low, page_high):
+            if x < len(head):
+                positions.append(head[x])
+            elif x < len(head) + inner_high - inner_low:
+                positions.append(inner_low + x - len(head))
+            else:
+                positions.append(tail[x - len(head) - inner_high + inner_low])
+        ids = self.arrays["date_ids"] if self.date_count else []
+        return page_result(total, page, per_page, [ids[x] for x in reversed(positions)])
+
+
+def page_bounds(total: int, page: int, per_page: int) -> List[int]:
+    # Positions in ascending order of the page, when results are listed from the end backwards
+    page_high = max(0, total - (page - 1) * per_page)
+    return [max(0, page_high - per_page), page_high]
+
+
+def page_result(total: int, page: int, per_page: int, ids: List[int]) -> dict:
+    return {
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "ids": ids
+    }
+
+
+def build_index(data_dir="data/", index_dir=INDEX_DIR, processes: int = None, segment_dir: str = None):
+    from scan import scan_records
+    records = scan_records(data_dir, ["username", "date"], processes=processes, segment_dir=segment_dir)
+    build_secondary_index(records, index_dir)
+
+
+if __name__ == "__main__":
+    # Usage: python secondary_index.py [data dir] [index dir]
+    build_index(*sys.argv[1:3])
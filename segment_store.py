@@ -0,0 +1,379 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Iterator, Tuple, List
+
+SEGMENT_SIZE = 1000000
+SLOT = struct.Struct("<qq")
+FIELDS = ["username", "title", "description", "keywords", "date", "rating", "filename"]
+INTERNED_FIELDS = ["username", "rating"]
+DIGEST_ENTRY = struct.Struct("<16sq")
+DIGEST_MERGE_ENTRIES = 65536
+NOT_SHARED = -1
+# Shorter descriptions are cheaper to keep inline than to point at
+DESCRIPTION_INLINE_LENGTH = 64
+
+
+class StringTable:
+    def __init__(self, filename):
+        self.filename = filename
+        self.strings = []
+        self.lookup = {}
+        self.lock = Lock()
+        self.reload()
+
+    def reload(self):
+        with self.lock:
+            if not os.path.exists(self.filename):
+                return
+            with open(self.filename, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+            # Ignore a trailing line which was only partly written
+            for line in lines[len(self.strings):]:
+                try:
+                    string = json.loads(line)
+                except ValueError:
+                    break
+                self.lookup[string] = len(self.strings)
+                self.strings.append(string)
+
+    def intern(self, strings: List[str]) -> List[int]:
+        with self.lock:
+            new_strings = []
+            for string in strings:
+                if string not in self.lookup:
+                    self.lookup[string] = len(self.strings)
+                    self.strings.append(string)
+                    new_strings.append(string)
+            if new_strings:
+                with open(self.filename, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(x) + "\n" for x in new_strings))
+            return [self.lookup[x] for x in strings]
+
+    def get(self, key: int) -> str:
+        if key >= len(self.strings):
+            # Another process may have added strings since we loaded the table
+            self.reload()
+        return self.strings[key]
+
+
+class SortedDigests:
+    # Lets bisect search the sorted digest file without reading it all
+    def __init__(self, mapped, count: int):
+        self.mapped = mapped
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position: int) -> bytes:
+        start = position * DIGEST_ENTRY.size
+        return self.mapped[start:start + 16]
+
+
+class DescriptionTable:
+    def __init__(self, prefix: str, cache_size=1024):
+        self.dat_file = prefix + ".desc"
+        self.idx_file = prefix + ".desc_idx"
+        self.digest_file = prefix + ".digests"
+        self.log_file = prefix + ".digests_log"
+        self.dat_fd = None
+        self.idx_fd = None
+        self.log_fd = None
+        self.writable = False
+        # Digests are only read when a batch is written, so read only stores never load them
+        self.pending = None
+        self.digests = None
+        self.digest_map = None
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = Lock()
+
+    def open_files(self, write: bool):
+        # One handle per file is kept open, reads use pread so they don't need the lock
+        if self.dat_fd is not None and (self.writable or not write):
+            return
+        if self.dat_fd is not None:
+            os.close(self.dat_fd)
+            os.close(self.idx_fd)
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND if write else os.O_RDONLY
+        self.dat_fd = os.open(self.dat_file, flags, 0o644)
+        self.idx_fd = os.open(self.idx_file, flags, 0o644)
+        self.writable = write
+
+    def open_digests(self):
+        if self.pending is not None:
+            return
+        self.map_digests()
+        self.pending = {}
+        self.log_fd = os.open(self.log_file, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        log_data = os.pread(self.log_fd, os.fstat(self.log_fd).st_size, 0)
+        # Ignore an entry which was only partly written
+        log_data = log_data[:len(log_data) - len(log_data) % DIGEST_ENTRY.size]
+        for digest, value in DIGEST_ENTRY.iter_unpack(log_data):
+            self.pending[digest] = value
+
+    def map_digests(self):
+        if self.digest_map is not None:
+            self.digest_map.close()
+        self.digest_map = None
+        self.digests = SortedDigests(b"", 0)
+        try:
+            with open(self.digest_file, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                self.digest_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        self.digests = SortedDigests(self.digest_map, len(self.digest_map) // DIGEST_ENTRY.size)
+
+    def lookup(self, digest: bytes) -> Optional[int]:
+        if digest in self.pending:
+            return self.pending[digest]
+        position = bisect_left(self.digests, digest)
+        if position == len(self.digests) or self.digests[position] != digest:
+            return None
+        return DIGEST_ENTRY.unpack_from(self.digest_map, position * DIGEST_ENTRY.size)[1]
+
+    def record(self, digest: bytes, value: int):
+        self.pending[digest] = value
+        os.write(self.log_fd, DIGEST_ENTRY.pack(digest, value))
+        if len(self.pending) >= DIGEST_MERGE_ENTRIES:
+            self.merge_digests()
+
+    def merge_digests(self):
+        # Newly recorded digests are kept in a log, and merged into the sorted file in bulk
+        old_entries = DIGEST_ENTRY.iter_unpack(self.digest_map) if self.digest_map is not None else iter([])
+        new_entries = sorted(self.pending.items())
+        position = 0
+        with open(self.digest_file + ".tmp", "wb") as f:
+            for digest, value in old_entries:
+                while position < len(new_entries) and new_entries[position][0] < digest:
+                    f.write(DIGEST_ENTRY.pack(*new_entries[position]))
+                    position += 1
+                if position < len(new_entries) and new_entries[position][0] == digest:
+                    # A description shared since the last merge replaces its first sighting
+                    value = new_entries[position][1]
+                    position += 1
+                f.write(DIGEST_ENTRY.pack(digest, value))
+            for entry in new_entries[position:]:
+                f.write(DIGEST_ENTRY.pack(*entry))
+        del old_entries
+        os.replace(self.digest_file + ".tmp", self.digest_file)
+        os.ftruncate(self.log_fd, 0)
+        self.pending = {}
+        self.map_digests()
+
+    def store(self, data: bytes) -> int:
+        block = zlib.compress(data, 9)
+        offset = os.fstat(self.dat_fd).st_size
+        os.write(self.dat_fd, block)
+        # Only index the description once it has been written
+        key = os.fstat(self.idx_fd).st_size // SLOT.size
+        os.write(self.idx_fd, SLOT.pack(offset, len(block)))
+        return key
+
+    def encode(self, description: Optional[str]):
+        if description is None or len(description) < DESCRIPTION_INLINE_LENGTH:
+            return description
+        data = description.encode("utf-8")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self.lock:
+            self.open_files(write=True)
+            self.open_digests()
+            value = self.lookup(digest)
+            if value is None:
+                # The first copy stays in the compressed batch, only descriptions which repeat are shared
+                self.record(digest, NOT_SHARED)
+                return description
+            if value == NOT_SHARED:
+                value = self.store(data)
+                self.record(digest, value)
+            return value
+
+    def get(self, key: int) -> str:
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.open_files(write=False)
+            idx_fd, dat_fd = self.idx_fd, self.dat_fd
+        offset, length = SLOT.unpack(os.pread(idx_fd, SLOT.size, key * SLOT.size))
+        description = zlib.decompress(os.pread(dat_fd, length, offset)).decode("utf-8")
+        with self.lock:
+            # Batches sharing a description also share the decoded string
+            description = self.cache.setdefault(key, description)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return description
+
+
+class SegmentStore:
+    def __init__(self, root="segments/", batch_size=100, cache_batches=16):
+        self.root = root
+        self.batch_size = batch_size
+        self.slots_per_segment = SEGMENT_SIZE // batch_size
+        os.makedirs(root, exist_ok=True)
+        self.strings = StringTable(os.path.join(root, "strings.jsonl"))
+        self.description_tables = {}
+        self.cache = OrderedDict()
+        self.cache_batches = cache_batches
+        self.lock = Lock()
+
+    def segment_files(self, batch_start: int) -> Tuple[str, str]:
+        segment = batch_start // SEGMENT_SIZE
+        return os.path.join(self.root, f"{segment:04}.dat"), os.path.join(self.root, f"{segment:04}.idx")
+
+    def description_table(self, segment: int) -> DescriptionTable:
+        # Repeated descriptions are shared within a segment, so each segment's digest index stays small
+        with self.lock:
+            if segment not in self.description_tables:
+                self.description_tables[segment] = DescriptionTable(os.path.join(self.root, f"{segment:04}"))
+            return self.description_tables[segment]
+
+    def slot_offset(self, batch_start: int) -> int:
+        return (batch_start % SEGMENT_SIZE) // self.batch_size * SLOT.size
+
+    def encode_batch(self, batch_start: int, full_data: dict) -> bytes:
+        descriptions = self.description_table(batch_start // SEGMENT_SIZE)
+        ids = sorted(int(x) for x in full_data.keys())
+        present = [sub_id for sub_id in ids if full_data[str(sub_id)] is not None]
+        entries = [full_data[str(sub_id)] for sub_id in present]
+        columns = {
+            "ids": ids,
+            "present": present,
+        }
+        for field in FIELDS:
+            values = [entry.get(field) for entry in entries]
+            if field in INTERNED_FIELDS:
+                values = self.intern_optional(values)
+            if field == "keywords":
+                values = [None if keywords is None else self.intern_optional(keywords) for keywords in values]
+            if field == "description":
+                values = [descriptions.encode(description) for description in values]
+            columns[field] = values
+        return zlib.compress(json.dumps(columns, separators=(",", ":")).encode("utf-8"), 9)
+
+    def intern_optional(self, strings: List[Optional[str]]) -> List[Optional[int]]:
+        keys = iter(self.strings.intern([x for x in strings if x is not None]))
+        return [None if x is None else next(keys) for x in strings]
+
+    def decode_batch(self, batch_start: int, block: bytes) -> dict:
+        descriptions = self.description_table(batch_start // SEGMENT_SIZE)
+        columns = json.loads(zlib.decompress(block).decode("utf-8"))
+        full_data = {str(sub_id): None for sub_id in columns["ids"]}
+        for position, sub_id in enumerate(columns["present"]):
+            entry = {"id": sub_id}
+            for field in FIELDS:
+                value = columns[field][position]
+                if field in INTERNED_FIELDS and value is not None:
+                    value = self.strings.get(value)
+                if field == "keywords" and value is not None:
+                    value = [None if x is None else self.strings.get(x) for x in value]
+                if field == "description" and isinstance(value, int):
+                    value = descriptions.get(value)
+                entry[field] = value
+            full_data[str(sub_id)] = entry
+        return full_data
+
+    def save_batch(self, batch_start: int, full_data: dict):
+        block = self.encode_batch(batch_start, full_data)
+        dat_file, idx_file = self.segment_files(batch_start)
+        with self.lock:
+            if not os.path.exists(idx_file):
+                with open(idx_file, "wb") as f:
+                    f.truncate(self.slots_per_segment * SLOT.size)
+            with open(dat_file, "ab") as f:
+                offset = f.tell()
+                f.write(block)
+            # Only point the index at the block once it has been written
+            with open(idx_file, "r+b") as f:
+                f.seek(self.slot_offset(batch_start))
+                f.write(SLOT.pack(offset, len(block)))
+            self.cache.pop(batch_start, None)
+
+    def read_slot(self, batch_start: int) -> Optional[Tuple[int, int]]:
+        _, idx_file = self.segment_files(batch_start)
+        try:
+            with open(idx_file, "rb") as f:
+                f.seek(self.slot_offset(batch_start))
+                offset, length = SLOT.unpack(f.read(SLOT.size))
+        except FileNotFoundError:
+            return None
+        if length == 0:
+            return None
+        return offset, length
+
+    def load_batch(self, batch_start: int) -> Optional[dict]:
+        with self.lock:
+            if batch_start in self.cache:
+                self.cache.move_to_end(batch_start)
+                return self.cache[batch_start]
+        slot = self.read_slot(batch_start)
+        if slot is None:
+            return None
+        dat_file, _ = self.segment_files(batch_start)
+        with open(dat_file, "rb") as f:
+            f.seek(slot[0])
+            full_data = self.decode_batch(batch_start, f.read(slot[1]))
+        with self.lock:
+            self.cache[batch_start] = full_data
+            while len(self.cache) > self.cache_batches:
+                self.cache.popitem(last=False)
+        return full_data
+
+    def get(self, sub_id: int) -> Optional[dict]:
+        batch_start = (sub_id // self.batch_size) * self.batch_size
+        full_data = self.load_batch(batch_start)
+        if full_data is None:
+            return None
+        return full_data.get(str(sub_id))
+
+    def segments(self) -> List[int]:
+        return sorted(int(os.path.basename(x).split(".")[0]) for x in glob.glob(os.path.join(self.root, "*.idx")))
+
+    def iter_batches(self, start: int = None, end: int = None) -> Iterator[Tuple[int, dict]]:
+        for segment in self.segments():
+            segment_start = segment * SEGMENT_SIZE
+            if end is not None and segment_start > end:
+                break
+            if start is not None and segment_start + SEGMENT_SIZE <= start:
+                continue
+            dat_file, idx_file = self.segment_files(segment_start)
+            with open(idx_file, "rb") as f:
+                index_data = f.read()
+            with open(dat_file, "rb") as dat:
+                for slot_num, (offset, length) in enumerate(SLOT.iter_unpack(index_data)):
+                    batch_start = segment_start + slot_num * self.batch_size
+                    if length == 0:
+                        continue
+                    if start is not None and batch_start + self.batch_size <= start:
+                        continue
+                    if end is not None and batch_start > end:
+                        break
+                    dat.seek(offset)
+                    yield batch_start, self.decode_batch(batch_start, dat.read(length))
+
+
+def convert_json_tree(data_dir="data/", root="segments/", batch_size=100):
+    store = SegmentStore(root, batch_size)
+    files = sorted(glob.glob(os.path.join(data_dir, "*", "*", "*.json")))
+    for count, file in enumerate(files):
+        batch_start = int(os.path.basename(file).split("-")[1])
+        with open(file, "r") as f:
+            store.save_batch(batch_start, json.load(f))
+        if count % 1000 == 0:
+            print(f"Converted {count} of {len(files)} batch files")
+
+
+if __name__ == "__main__":
+    # Usage: python segment_store.py [data dir] [segment dir]
+    convert_json_tree(*sys.argv[1:3])
@@ -1,11 +1,28 @@
+import gzip
+import io
 import json
+import os
 import uuid
+import zlib
+import dateutil.parser as parser
 from functools import wraps
 from pathlib import Path
 
 import flask as flask
 from flask import request, abort
 
+from atomic_file import write_atomic
+from coordinator import Coordinator
+from index_updater import IndexUpdater
+from scan import batch_files
+from search_index import SearchIndex
+from secondary_index import SecondaryIndex
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 def load_or_create_config():
     try:
@@ -37,52 +54,305 @@ def auth_required(f):
 
 CONFIG = load_or_create_config()
 app = flask.Flask(__name__)
+SEARCH_INDEX = SearchIndex(CONFIG.get("SEARCH_INDEX_DIR", "index/search/"))
+SECONDARY_INDEX = SecondaryIndex(CONFIG.get("SECONDARY_INDEX_DIR", "index/secondary/"))
+INDEX_UPDATER = IndexUpdater(SEARCH_INDEX, CONFIG.get("INDEX_FLUSH_INTERVAL", 2))
+# With several WSGI workers, run index_updater.py as its own process instead
+if CONFIG.get("RUN_INDEX_UPDATER", True):
+    INDEX_UPDATER.start()
+PRECOMPRESS = [x for x in CONFIG.get("PRECOMPRESS", ["gzip", "zstd"]) if x != "zstd" or zstandard is not None]
+ENCODING_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+# High levels cost far more CPU per upload than they save in bytes on small JSON batches
+GZIP_LEVEL = CONFIG.get("GZIP_LEVEL", 6)
+ZSTD_LEVEL = CONFIG.get("ZSTD_LEVEL", 3)
+# Lease state is held in memory, so the coordinator must run in a single server process
+COORDINATOR = Coordinator(CONFIG["COORDINATOR"]) if "COORDINATOR" in CONFIG else None
 
 
-@auth_required
-@app.route("/", defaults={'path': ''})
-@app.route("/<path:path>")
-def catch_all_get(path):
-    # Must have a filename ending .json
-    if path.endswith(".json"):
-        abort(401)
+def page_args(default_per_page: int = 50, max_per_page: int = 500):
+    page = max(1, int(request.args.get("page", 1)))
+    per_page = min(max_per_page, max(1, int(request.args.get("per_page", default_per_page))))
+    return page, per_page
+
+
+@app.route("/search")
+def search():
+    SEARCH_INDEX.reload_if_changed()
+    query = request.args.get("q", "")
+    try:
+        date_from = parser.parse(request.args["from"]) if "from" in request.args else None
+        date_to = parser.parse(request.args["to"]) if "to" in request.args else None
+        page, per_page = page_args()
+        results = SEARCH_INDEX.query(query, date_from, date_to, page, per_page)
+    except ValueError:
+        abort(400)
+        return
+    return flask.jsonify(results)
+
+
+@app.route("/users")
+def users():
+    SECONDARY_INDEX.reload_if_changed()
+    try:
+        page, per_page = page_args(500, 5000)
+    except ValueError:
+        abort(400)
+        return
+    return flask.jsonify(SECONDARY_INDEX.list_users(request.args.get("prefix", ""), page, per_page))
+
+
+@app.route("/users/<username>")
+def user_submissions(username):
+    SECONDARY_INDEX.reload_if_changed()
+    try:
+        page, per_page = page_args()
+    except ValueError:
+        abort(400)
+        return
+    return flask.jsonify(SECONDARY_INDEX.user_query(username, page, per_page))
+
+
+@app.route("/dates")
+def date_submissions():
+    SECONDARY_INDEX.reload_if_changed()
+    try:
+        date_from = int(parser.parse(request.args["from"]).timestamp()) if "from" in request.args else None
+        date_to = int(parser.parse(request.args["to"]).timestamp()) if "to" in request.args else None
+        page, per_page = page_args()
+    except ValueError:
+        abort(400)
         return
+    return flask.jsonify(SECONDARY_INDEX.date_query(date_from, date_to, page, per_page))
+
+
+def data_path_for(path: str):
+    # Must have a filename ending .json
+    if not path.endswith(".json"):
+        return None
     # Resolve paths
     data_path = Path("./data/").resolve()
     file_path = Path(path).resolve()
     # Must be in data directory
     if data_path not in file_path.parents:
+        return None
+    return file_path
+
+
+def coordinator_required(f):
+    @wraps(f)
+    def decorated_func(*args, **kwargs):
+        if COORDINATOR is None:
+            abort(404)
+        return f(*args, **kwargs)
+    return decorated_func
+
+
+@app.route("/coordinator/lease", methods=['POST'])
+@auth_required
+@coordinator_required
+def coordinator_lease():
+    worker = (request.json or {}).get("worker")
+    if not worker:
+        abort(400)
+        return
+    return flask.jsonify(COORDINATOR.acquire(worker))
+
+
+@app.route("/coordinator/heartbeat", methods=['POST'])
+@auth_required
+@coordinator_required
+def coordinator_heartbeat():
+    data = request.json or {}
+    lease = COORDINATOR.heartbeat(data.get("lease_id"), data.get("completed", []))
+    if lease is None:
+        abort(409)
+        return
+    return flask.jsonify(lease)
+
+
+@app.route("/coordinator/complete", methods=['POST'])
+@auth_required
+@coordinator_required
+def coordinator_complete():
+    data = request.json or {}
+    if not COORDINATOR.complete(data.get("lease_id"), data.get("completed", [])):
+        abort(409)
+        return
+    return flask.jsonify({"completed": True})
+
+
+@app.route("/coordinator/status")
+@auth_required
+@coordinator_required
+def coordinator_status():
+    return flask.jsonify(COORDINATOR.status())
+
+
+def resolve_data_path(path: str) -> Path:
+    file_path = data_path_for(path)
+    if file_path is None:
         abort(401)
+    return file_path
+
+
+def compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def write_compressed(file_path: Path, encoding: str, data: bytes, mtime_ns: int):
+    encoded_path = Path(str(file_path) + ENCODING_SUFFIXES[encoding])
+    write_atomic(encoded_path, compress(encoding, data))
+    # Stamped with the modification time of the plain file it was made from, so a copy of an older version is never sent
+    os.utime(encoded_path, ns=(mtime_ns, mtime_ns))
+
+
+def accepted_encoding(file_path: Path):
+    mtime_ns = file_path.stat().st_mtime_ns
+    for encoding in ["zstd", "gzip"]:
+        if request.accept_encodings.quality(encoding) <= 0:
+            continue
+        encoded_path = Path(str(file_path) + ENCODING_SUFFIXES[encoding])
+        if encoded_path.exists() and encoded_path.stat().st_mtime_ns == mtime_ns:
+            return encoding, encoded_path
+        if encoding in PRECOMPRESS:
+            # Missing or out of date, so compress it once now for this and later reads
+            write_compressed(file_path, encoding, file_path.read_bytes(), mtime_ns)
+            return encoding, encoded_path
+    return None, file_path
+
+
+def write_batch_file(file_path: Path, data: bytes, precompress: bool = True):
+    # Store precompressed copies next to the plain file, so reads can send them as they are
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    write_atomic(file_path, data)
+    if not precompress:
         return
-    with file_path.open("r") as f:
-        return f.read()
+    mtime_ns = file_path.stat().st_mtime_ns
+    for encoding in PRECOMPRESS:
+        write_compressed(file_path, encoding, data, mtime_ns)
+
+
+@app.route("/bulk")
+@auth_required
+def bulk_get():
+    try:
+        start = int(request.args["start"])
+        end = int(request.args["end"])
+    except (KeyError, ValueError):
+        abort(400)
+        return
+    if end < start or end - start > CONFIG.get("BULK_MAX_IDS", 1000000):
+        abort(400)
+        return
+    gzip_response = request.accept_encodings.quality("gzip") > 0
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_response else None
+        for filename in batch_files("data/", start, end):
+            path = Path(filename).as_posix()
+            with open(filename, "rb") as f:
+                chunk = b'{"path": ' + json.dumps(path).encode() + b', "batch": ' + f.read().strip() + b'}\n'
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+
+    response = flask.Response(generate(), mimetype="application/x-ndjson")
+    if gzip_response:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def decompressed_stream():
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=request.stream)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(request.stream)
+    if encoding == "identity":
+        return request.stream
+    abort(415)
+
+
+LINE_PREFIX = '{"path": '
+BATCH_SEPARATOR = ', "batch": '
+DECODER = json.JSONDecoder()
 
 
+def split_upload_line(line: str):
+    # Lines written by the uploader are sliced apart, so the batch JSON is stored without being re-encoded
+    if line.startswith(LINE_PREFIX):
+        path, end = DECODER.raw_decode(line, len(LINE_PREFIX))
+        if line.startswith(BATCH_SEPARATOR, end) and line.endswith("}"):
+            batch_json = line[end + len(BATCH_SEPARATOR):-1]
+            return path, batch_json, json.loads(batch_json)
+    entry = json.loads(line)
+    return entry["path"], json.dumps(entry["batch"]), entry["batch"]
+
+
+@app.route("/bulk", methods=['POST'])
+@auth_required
+def bulk_post():
+    results = []
+    lines = io.TextIOWrapper(decompressed_stream(), encoding="utf-8")
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            path, batch_json, batch = split_upload_line(line)
+        except (ValueError, KeyError, TypeError) as e:
+            results.append({"path": None, "status": "error", "error": f"Invalid line: {e}"})
+            continue
+        file_path = data_path_for(path)
+        if file_path is None or not isinstance(batch, dict):
+            results.append({"path": path, "status": "rejected"})
+            continue
+        try:
+            # Compressing is left to the first read, so a bulk upload only pays for writing the batches
+            write_batch_file(file_path, batch_json.encode(), precompress=False)
+            INDEX_UPDATER.append_line(path, batch_json)
+        except OSError as e:
+            results.append({"path": path, "status": "error", "error": str(e)})
+            continue
+        results.append({"path": path, "status": "saved"})
+    return flask.jsonify({"results": results})
+
+
+@app.route("/", defaults={'path': ''})
+@app.route("/<path:path>")
 @auth_required
+def catch_all_get(path):
+    file_path = resolve_data_path(path)
+    if not file_path.exists():
+        abort(404)
+        return
+    encoding, send_path = accepted_encoding(file_path)
+    response = flask.send_file(str(send_path), mimetype="application/json", conditional=True, etag=True)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
 @app.route('/', defaults={'path': ''}, methods=['POST'])
 @app.route('/<path:path>', methods=['POST'])
+@auth_required
 def catch_all_post(path):
     # Must POST json data
     if not request.json:
         abort(401)
         return
-    # Must have a filename ending .json
-    if path.endswith(".json"):
-        abort(401)
-        return
-    # Resolve paths
-    data_path = Path("./data/").resolve()
-    file_path = Path(path).resolve()
-    # Must be in data directory
-    if data_path not in file_path.parents:
-        abort(401)
-        return
-    # Create parent directory
-    file_path.parent.mkdir(parents=True, exist_ok=True)
+    file_path = resolve_data_path(path)
     # Write file
-    with file_path.open("w") as f:
-        json.dump(request.json, f)
-        return f"Saved {path}"
+    write_batch_file(file_path, json.dumps(request.json).encode())
+    INDEX_UPDATER.append(path, request.json)
+    return f"Saved {path}"
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    def __init__(self, workers: int, per_host: int = None, user_agent: str = None):
+        self.workers = workers
+        self.per_host = per_host or workers
+        self.session = requests.Session()
+        if user_agent is not None:
+            self.session.headers["User-Agent"] = user_agent
+        self.adapter = HTTPAdapter(
+            pool_connections=workers,
+            pool_maxsize=self.per_host,
+            pool_block=True
+        )
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.request_count = 0
+        self.lock = Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.request_count += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            pool_list = list(pools._container.items())
+        for key, pool in pool_list:
+            hosts[f"{key.key_scheme}://{key.key_host}"] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests
+            }
+        connections = sum(x["connections"] for x in hosts.values())
+        return {
+            "requests": self.request_count,
+            "connections": connections,
+            "reused": self.request_count - connections,
+            "hosts": hosts
+        }
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,138 @@
+import datetime
+import os
+import random
+
+import pytest
+
+from search_index import (
+    Query, SearchIndex, compact, decode_postings, encode_postings, gallop_down, index_records, read_manifest,
+    terms_for_record, without_ranges, write_manifest, write_segment
+)
+
+WORDS = ["fox", "deer", "wolf", "owl"]
+BASE_DATE = datetime.datetime(2020, 1, 1)
+QUERIES = ["fox", "fox deer", "fox OR owl -wolf", "user:user3 NOT deer", "title:wolf keyword:owl", "rating:adult fox"]
+DATE_RANGES = [(None, None), (300, 900), (None, 150), (1200, None), (5000, None)]
+
+
+def make_record(sub_id: int, rng: random.Random, minutes: int = None) -> dict:
+    if minutes is None:
+        # Roughly in ID order, with some dates out of place
+        minutes = sub_id + rng.randint(-40, 40)
+    return {
+        "id": sub_id,
+        "username": f"user{rng.randrange(7)}",
+        "title": " ".join(rng.sample(WORDS, 2)),
+        "keywords": rng.sample(WORDS, rng.randint(0, 2)),
+        "rating": rng.choice(["general", "mature", "adult"]),
+        "date": (BASE_DATE + datetime.timedelta(minutes=minutes)).isoformat()
+    }
+
+
+def minutes(offset):
+    return None if offset is None else BASE_DATE + datetime.timedelta(minutes=offset)
+
+
+def brute_force(records: dict, query: str, date_from=None, date_to=None) -> list:
+    parsed = Query.parse(query)
+    matches = []
+    for sub_id in sorted(records, reverse=True):
+        record = records[sub_id]
+        terms = terms_for_record(record)
+        if not all(any(x in terms for x in group) for group in parsed.groups):
+            continue
+        if any(x in terms for x in parsed.excluded):
+            continue
+        date = datetime.datetime.fromisoformat(record["date"])
+        if (date_from is not None and date < date_from) or (date_to is not None and date > date_to):
+            continue
+        matches.append(sub_id)
+    return matches
+
+
+def all_pages(index: SearchIndex, query: str, date_from, date_to, per_page: int) -> list:
+    ids = []
+    page = 1
+    while True:
+        result = index.query(query, date_from, date_to, page, per_page)
+        ids += result["ids"]
+        if not result["more"]:
+            assert result["total"] == len(ids)
+            return ids
+        assert result["total"] is None
+        page += 1
+
+
+def add_segment(index_dir: str, name: str, records: list, covered=None):
+    postings, doc_ids, doc_dates = index_records(sorted(records, key=lambda x: x["id"]))
+    write_segment(os.path.join(index_dir, name), postings, doc_ids, doc_dates, covered)
+    manifest = read_manifest(index_dir)
+    manifest["segments"].append(name)
+    manifest["next_segment"] += 1
+    write_manifest(index_dir, manifest)
+
+
+def assert_matches(index: SearchIndex, records: dict):
+    for query in QUERIES:
+        for start, end in DATE_RANGES:
+            expected = brute_force(records, query, minutes(start), minutes(end))
+            assert all_pages(index, query, minutes(start), minutes(end), 37) == expected, (query, start, end)
+
+
+def test_postings_round_trip():
+    rng = random.Random(1)
+    sub_ids = sorted(set(rng.randrange(1 << 40) for _ in range(2000)) | {0, 1, 127, 128, 16383, 16384})
+    data = encode_postings(sub_ids)
+    assert list(decode_postings(data)) == sub_ids
+    assert list(decode_postings(encode_postings([]))) == []
+
+
+def test_gallop_down_matches_bisect():
+    rng = random.Random(2)
+    values = sorted(set(rng.randrange(10000) for _ in range(500)))
+    high = len(values)
+    for target in sorted(rng.sample(range(10000), 300), reverse=True):
+        position = gallop_down(values, target, high)
+        assert position == sum(1 for x in values[:high] if x < target)
+        high = position
+
+
+def test_without_ranges():
+    sub_ids = list(range(0, 100, 3))
+    kept = without_ranges(sub_ids, [[10, 20], [50, 50], [90, 200]])
+    assert list(kept) == [x for x in sub_ids if not (10 <= x <= 20 or x == 50 or x >= 90)]
+
+
+def test_queries_match_brute_force(tmp_path):
+    rng = random.Random(3)
+    records = {x: make_record(x, rng) for x in range(1, 1500)}
+    add_segment(str(tmp_path), "base-1", list(records.values()))
+    assert_matches(SearchIndex(str(tmp_path)), records)
+
+
+def test_excluded_only_query_is_rejected(tmp_path):
+    rng = random.Random(4)
+    add_segment(str(tmp_path), "base-1", [make_record(x, rng) for x in range(1, 50)])
+    with pytest.raises(ValueError):
+        SearchIndex(str(tmp_path)).query("-fox")
+
+
+def test_delta_segments_shadow_and_compact(tmp_path):
+    rng = random.Random(5)
+    index_dir = str(tmp_path)
+    records = {x: make_record(x, rng) for x in range(1, 1200)}
+    add_segment(index_dir, "base-1", list(records.values()))
+    # Each delta replaces a range of batches, including submissions which have since been removed
+    for number, (start, end) in enumerate([(100, 199), (150, 349), (1000, 1299)], 2):
+        replaced = {x: make_record(x, rng) for x in range(start, end + 1) if rng.random() > 0.2}
+        for sub_id in range(start, end + 1):
+            records.pop(sub_id, None)
+        records.update(replaced)
+        add_segment(index_dir, f"delta-{number}", list(replaced.values()), [[start, end]])
+    assert_matches(SearchIndex(index_dir), records)
+    compact(index_dir)
+    assert len(read_manifest(index_dir)["segments"]) == 2
+    assert_matches(SearchIndex(index_dir), records)
+    compact(index_dir, include_base=True)
+    assert len(read_manifest(index_dir)["segments"]) == 1
+    assert_matches(SearchIndex(index_dir), records)
@@ -0,0 +1,68 @@
+import datetime
+import random
+
+from search_index import DATE_BLOCK, parse_timestamp
+from secondary_index import SecondaryIndex, build_secondary_index
+
+BASE_DATE = datetime.datetime(2020, 1, 1)
+
+
+def make_records(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    records = []
+    for sub_id in range(1, count + 1):
+        # Dates drift further than a block from ID order, so blocks overlap, and some are missing
+        date = BASE_DATE + datetime.timedelta(minutes=sub_id + rng.randint(-3 * DATE_BLOCK, 3 * DATE_BLOCK))
+        records.append({
+            "id": sub_id,
+            "username": rng.choice(["alpha", "beta", "gamma", None]),
+            "date": None if rng.random() < 0.05 else date.isoformat()
+        })
+    return records
+
+
+def all_pages(query, per_page: int) -> list:
+    ids = []
+    page = 1
+    while True:
+        result = query(page, per_page)
+        ids += result["ids"]
+        if len(ids) >= result["total"]:
+            assert len(ids) == result["total"]
+            assert query(page + 1, per_page)["ids"] == []
+            return ids
+        assert len(result["ids"]) == per_page
+        page += 1
+
+
+def test_date_queries_with_out_of_order_dates(tmp_path):
+    records = make_records(5 * DATE_BLOCK + 17, 1)
+    build_secondary_index(records, str(tmp_path))
+    index = SecondaryIndex(str(tmp_path))
+    times = {x["id"]: parse_timestamp(x["date"]) for x in records if x["date"]}
+    low, high = min(times.values()), max(times.values())
+    rng = random.Random(2)
+    ranges = [(None, None), (low, None), (None, high), (high + 1, None), (None, low - 1), (low + 60, low + 60)]
+    for _ in range(30):
+        ranges.append(tuple(sorted(rng.randint(low, high) for _ in range(2))))
+    for start, end in ranges:
+        expected = sorted((sub_id for sub_id, time in times.items()
+                           if (start is None or time >= start) and (end is None or time <= end)), reverse=True)
+        assert sorted(index.date_range_ids(start, end), reverse=True) == expected
+        assert all_pages(lambda page, per_page: index.date_query(start, end, page, per_page), 97) == expected
+
+
+def test_user_queries(tmp_path):
+    records = make_records(1000, 3)
+    build_secondary_index(records, str(tmp_path))
+    index = SecondaryIndex(str(tmp_path))
+    for username in ["alpha", "beta", "gamma", "delta"]:
+        expected = sorted((x["id"] for x in records if x["username"] == username), reverse=True)
+        assert all_pages(lambda page, per_page: index.user_query(username, page, per_page), 33) == expected
+
+
+def test_empty_index(tmp_path):
+    build_secondary_index([], str(tmp_path))
+    index = SecondaryIndex(str(tmp_path))
+    assert index.date_query()["ids"] == []
+    assert index.user_query("alpha")["total"] == 0
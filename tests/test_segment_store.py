@@ -0,0 +1,74 @@
+import os
+import random
+
+import segment_store
+from segment_store import DESCRIPTION_INLINE_LENGTH, SegmentStore
+
+BATCH_SIZE = 100
+
+
+def make_batches(count: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    shared = [f"Commission info {x}. " * 8 for x in range(5)]
+    batches = {}
+    for batch_start in range(0, count * BATCH_SIZE, BATCH_SIZE):
+        full_data = {}
+        for sub_id in range(batch_start, batch_start + BATCH_SIZE):
+            if rng.random() < 0.1:
+                # Deleted submissions are kept as nulls
+                full_data[str(sub_id)] = None
+                continue
+            full_data[str(sub_id)] = {
+                "id": sub_id,
+                "username": rng.choice(["alpha", "beta", None]),
+                "title": f"Title {sub_id}",
+                "description": rng.choice(shared + [None, "short", f"Unique description {sub_id} " * 5]),
+                "keywords": rng.choice([None, [], ["fox", "deer"], ["fox"]]),
+                "date": rng.choice([None, "2020-01-01T00:00:00"]),
+                "rating": rng.choice(["general", "adult", None]),
+                "filename": rng.choice([None, f"{sub_id}.png"])
+            }
+        batches[batch_start] = full_data
+    return batches
+
+
+def test_batches_round_trip(tmp_path):
+    batches = make_batches(20, 1)
+    store = SegmentStore(str(tmp_path), BATCH_SIZE)
+    for batch_start, full_data in batches.items():
+        store.save_batch(batch_start, full_data)
+    # A new store reads everything back from disk rather than its cache
+    store = SegmentStore(str(tmp_path), BATCH_SIZE)
+    for batch_start, full_data in batches.items():
+        assert store.load_batch(batch_start) == full_data
+    assert store.load_batch(len(batches) * BATCH_SIZE) is None
+
+
+def test_only_repeated_descriptions_are_shared(tmp_path, monkeypatch):
+    # Merge digests often so lookups go through both the sorted digests and the pending ones
+    monkeypatch.setattr(segment_store, "DIGEST_MERGE_ENTRIES", 64)
+    batches = make_batches(20, 2)
+    store = SegmentStore(str(tmp_path), BATCH_SIZE)
+    for batch_start, full_data in batches.items():
+        store.save_batch(batch_start, full_data)
+    descriptions = {}
+    for full_data in batches.values():
+        for entry in full_data.values():
+            if entry and entry["description"] and len(entry["description"]) >= DESCRIPTION_INLINE_LENGTH:
+                descriptions[entry["description"]] = descriptions.get(entry["description"], 0) + 1
+    repeated = [x for x, count in descriptions.items() if count > 1]
+    table = store.description_table(0)
+    assert os.path.getsize(table.idx_file) // segment_store.SLOT.size == len(repeated)
+    assert sorted(table.get(x) for x in range(len(repeated))) == sorted(repeated)
+    store = SegmentStore(str(tmp_path), BATCH_SIZE)
+    for batch_start, full_data in batches.items():
+        assert store.load_batch(batch_start) == full_data
+
+
+def test_overwritten_batch(tmp_path):
+    batches = make_batches(2, 3)
+    store = SegmentStore(str(tmp_path), BATCH_SIZE)
+    store.save_batch(0, batches[0])
+    store.save_batch(0, batches[100])
+    assert store.load_batch(0) == batches[100]
+    assert SegmentStore(str(tmp_path), BATCH_SIZE).load_batch(0) == batches[100]
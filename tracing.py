@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from threading import Lock, Thread, Event
+from typing import Optional
+
+from atomic_file import write_atomic
+
+# Shared by every span while tracing is off, so a disabled span costs one attribute check and no allocation
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    __slots__ = ["tracer", "name", "args", "start"]
+
+    def __init__(self, tracer: "Tracer", name: str, args: Optional[dict]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.tracer.stack().append([self.name, 0])
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter_ns() - self.start
+        self.tracer.finish(self, duration)
+        return False
+
+
+class Tracer:
+    def __init__(self, trace_dir: Optional[str] = None, sample_interval: Optional[float] = None):
+        self.trace_dir = trace_dir
+        self.enabled = trace_dir is not None
+        self.sample_interval = sample_interval
+        self.local = threading.local()
+        self.events = []
+        self.stacks = {}
+        self.samples = {}
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.origin = time.perf_counter_ns()
+        self.trace_started = False
+        self.stop_sampling = Event()
+        if self.enabled:
+            os.makedirs(trace_dir, exist_ok=True)
+            if sample_interval:
+                Thread(target=self.sample_loop, daemon=True).start()
+
+    def span(self, name: str, args: Optional[dict] = None):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def stack(self) -> list:
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def finish(self, span: Span, duration: int):
+        stack = self.stack()
+        name, child_time = stack.pop()
+        # Collapsed stacks count self time, so a flamegraph's widths add up to the wall time of each thread
+        collapsed = ";".join([x[0] for x in stack] + [name])
+        if stack:
+            stack[-1][1] += duration
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (span.start - self.origin) / 1000,
+            "dur": duration / 1000,
+            "pid": self.pid,
+            "tid": threading.get_ident()
+        }
+        if span.args:
+            event["args"] = span.args
+        with self.lock:
+            self.events.append(event)
+            self.stacks[collapsed] = self.stacks.get(collapsed, 0) + duration - child_time
+
+    def add(self, name: str, start: int, duration: int, pid: Optional[int] = None, args: Optional[dict] = None):
+        # Records a span timed elsewhere, such as in a process pool worker, where perf_counter_ns shares one clock, or
+        # in a coroutine, which can't use the thread's stack. It is filed under the caller's current stack, without
+        # counting against its time
+        if not self.enabled:
+            return
+        collapsed = ";".join([x[0] for x in self.stack()] + [name])
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) / 1000,
+            "dur": duration / 1000,
+            "pid": self.pid if pid is None else pid,
+            "tid": threading.get_ident() if pid is None else pid
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+            self.stacks[collapsed] = self.stacks.get(collapsed, 0) + duration
+
+    def sample_loop(self):
+        sampler_id = threading.get_ident()
+        while not self.stop_sampling.wait(self.sample_interval):
+            frames = sys._current_frames()
+            counts = {}
+            for thread_id, frame in frames.items():
+                if thread_id == sampler_id:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                collapsed = ";".join(reversed(names))
+                counts[collapsed] = counts.get(collapsed, 0) + 1
+            with self.lock:
+                for collapsed, count in counts.items():
+                    self.samples[collapsed] = self.samples.get(collapsed, 0) + count
+
+    def write_collapsed(self, filename: str, counts: dict):
+        lines = [f"{collapsed} {count}\n" for collapsed, count in sorted(counts.items())]
+        write_atomic(filename, "".join(lines).encode())
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+            stacks = dict(self.stacks)
+            samples = dict(self.samples)
+        # Chrome's trace viewer accepts an unterminated JSON array, so events are appended after every batch
+        with open(os.path.join(self.trace_dir, "trace.json"), "a" if self.trace_started else "w") as f:
+            if not self.trace_started:
+                f.write("[\n")
+                self.trace_started = True
+            for event in events:
+                f.write(json.dumps(event) + ",\n")
+        self.write_collapsed(os.path.join(self.trace_dir, "spans.folded"), {k: v // 1000 for k, v in stacks.items()})
+        if self.sample_interval:
+            self.write_collapsed(os.path.join(self.trace_dir, "samples.folded"), samples)
+
+    def close(self):
+        self.stop_sampling.set()
+        self.flush()
+
+
+NULL_TRACER = Tracer()
@@ -0,0 +1,196 @@
+import gzip
+import json
+import os
+import random
+import time
+from collections import Counter
+from threading import Thread, Condition
+from typing import List, Optional, Tuple
+
+from atomic_file import write_atomic
+
+
+class Uploader:
+    def __init__(self, session, upload_config: dict, user_agent: str, spool_dir="upload_spool/"):
+        self.session = session
+        self.url = upload_config["URL"]
+        self.key = upload_config["KEY"]
+        self.user_agent = user_agent
+        self.batches_per_request = upload_config.get("BATCHES_PER_REQUEST", 20)
+        self.max_backoff = upload_config.get("MAX_BACKOFF", 300)
+        self.max_attempts = upload_config.get("MAX_ATTEMPTS", 5)
+        self.spool_dir = spool_dir
+        self.rejected_dir = os.path.join(spool_dir, "rejected")
+        self.bulk_supported = True
+        self.backoff = 0
+        self.attempts = Counter()
+        self.rejected_paths = set()
+        self.condition = Condition()
+        os.makedirs(self.rejected_dir, exist_ok=True)
+        # Entries spooled before a restart are uploaded first
+        self.queue = self.spooled_files()
+        self.queued_paths = Counter(self.path_for(x) for x in self.queue)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def spooled_files(self) -> List[str]:
+        return sorted(
+            x for x in os.listdir(self.spool_dir)
+            if not x.endswith(".tmp") and os.path.isfile(os.path.join(self.spool_dir, x))
+        )
+
+    @staticmethod
+    def path_for(name: str) -> str:
+        # Entries spooled by older versions have no time prefix
+        if name[:20].isdigit() and name[20:21] == "-":
+            name = name[21:]
+        return name.replace("_", "/")
+
+    def spool(self, path: str, full_data: dict):
+        # Names are unique, so spooling a path again never replaces a copy which is being uploaded
+        name = f"{time.time_ns():020}-{path.replace('/', '_')}"
+        spool_file = os.path.join(self.spool_dir, name)
+        # Only complete entries are visible to the upload thread
+        write_atomic(spool_file, json.dumps({"path": path, "batch": full_data}).encode())
+        with self.condition:
+            self.queue.append(name)
+            self.queued_paths[path] += 1
+            self.condition.notify_all()
+
+    def pending(self) -> List[str]:
+        with self.condition:
+            return list(self.queue)
+
+    def is_pending(self, path: str) -> bool:
+        with self.condition:
+            return self.queued_paths[path] > 0
+
+    def is_delivered(self, path: str) -> bool:
+        # Only true once the server has saved the latest copy of the path
+        with self.condition:
+            return self.queued_paths[path] == 0 and path not in self.rejected_paths
+
+    def wait_for(self, paths: List[str]):
+        with self.condition:
+            while any(self.queued_paths[x] > 0 for x in paths):
+                self.condition.wait(30)
+
+    def load(self, path: str) -> Optional[dict]:
+        # The newest spooled copy is ahead of the server, otherwise the server has the only copy
+        with self.condition:
+            spooled = [x for x in self.queue if self.path_for(x) == path]
+        if spooled:
+            with open(os.path.join(self.spool_dir, spooled[-1]), "r") as f:
+                return json.load(f)["batch"]
+        resp = self.session.get(self.url + path, headers=self.headers())
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    def headers(self):
+        return {
+            "Authorization": self.key,
+            "User-Agent": self.user_agent
+        }
+
+    def read_entries(self, names: List[str]) -> Tuple[List[dict], List[str]]:
+        entries = []
+        malformed = []
+        for name in names:
+            try:
+                with open(os.path.join(self.spool_dir, name), "r") as f:
+                    entry = json.load(f)
+                if not isinstance(entry, dict) or "path" not in entry or "batch" not in entry:
+                    raise ValueError("missing path or batch")
+            except ValueError as e:
+                print(f"Spooled batch {name} is malformed: {e}")
+                malformed.append(name)
+                continue
+            entry["spool_file"] = name
+            entries.append(entry)
+        return entries, malformed
+
+    def send_bulk(self, entries: List[dict]) -> Tuple[List[str], List[str]]:
+        body = "".join(json.dumps({"path": x["path"], "batch": x["batch"]}) + "\n" for x in entries)
+        headers = self.headers()
+        headers["Content-Type"] = "application/x-ndjson"
+        headers["Content-Encoding"] = "gzip"
+        resp = self.session.post(self.url + "bulk", data=gzip.compress(body.encode()), headers=headers)
+        if resp.status_code in [404, 405]:
+            print("Upload server does not support bulk uploads, sending batches one at a time")
+            self.bulk_supported = False
+            return [], []
+        resp.raise_for_status()
+        # Results are in the order of the lines sent
+        acknowledged = []
+        failed = []
+        for entry, result in zip(entries, resp.json()["results"]):
+            if result["status"] == "saved":
+                acknowledged.append(entry["spool_file"])
+            else:
+                failed.append(entry["spool_file"])
+        return acknowledged, failed
+
+    def send_single(self, entry: dict) -> Tuple[List[str], List[str]]:
+        resp = self.session.post(self.url + entry["path"], json=entry["batch"], headers=self.headers())
+        if 400 <= resp.status_code < 500 and resp.status_code != 429:
+            return [], [entry["spool_file"]]
+        resp.raise_for_status()
+        return [entry["spool_file"]], []
+
+    def upload(self, names: List[str]) -> Tuple[List[str], List[str]]:
+        entries, malformed = self.read_entries(names)
+        for name in malformed:
+            self.reject(name)
+        if not entries:
+            return [], []
+        if self.bulk_supported:
+            return self.send_bulk(entries)
+        return self.send_single(entries[0])
+
+    def finish(self, name: str):
+        with self.condition:
+            self.queue.remove(name)
+            self.queued_paths[self.path_for(name)] -= 1
+            self.attempts.pop(name, None)
+            self.condition.notify_all()
+
+    def reject(self, name: str):
+        print(f"Moving spooled batch {name} to {self.rejected_dir}")
+        os.replace(os.path.join(self.spool_dir, name), os.path.join(self.rejected_dir, name))
+        with self.condition:
+            self.rejected_paths.add(self.path_for(name))
+        self.finish(name)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                count = self.batches_per_request if self.bulk_supported else 1
+                sending = self.queue[:count]
+            try:
+                acknowledged, failed = self.upload(sending)
+                for name in acknowledged:
+                    os.remove(os.path.join(self.spool_dir, name))
+                    with self.condition:
+                        self.rejected_paths.discard(self.path_for(name))
+                    self.finish(name)
+                for name in failed:
+                    self.attempts[name] += 1
+                    if self.attempts[name] >= self.max_attempts:
+                        self.reject(name)
+                if failed:
+                    raise Exception(f"Server did not save {len(failed)} batches")
+                self.backoff = 0
+            except Exception as e:
+                self.backoff = min(self.max_backoff, max(1, self.backoff * 2))
+                print(f"Upload failed, {len(self.pending())} batches spooled, retrying in {self.backoff}s: {e}")
+                time.sleep(self.backoff * random.uniform(0.5, 1.5))
+
+    def wait_until_empty(self):
+        with self.condition:
+            while self.queue:
+                print(f"Waiting for {len(self.queue)} spooled batches to upload")
+                self.condition.wait(30)
@@ -0,0 +1,8 @@
+# WSGI entry point for running server.py with several worker processes, for example:
+#   gunicorn --workers 4 --bind 0.0.0.0:17985 wsgi:application
+# or on Windows:
+#   waitress-serve --threads 16 --port 17985 wsgi:application
+# Set "RUN_INDEX_UPDATER": false in config-server.json when using more than one worker,
+# and run `python index_updater.py` alongside it, so only one process writes index segments.
+# The work coordinator keeps leases in memory, so a server with "COORDINATOR" set must use one worker.
+from server import app as application